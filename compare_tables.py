@@ -2,34 +2,350 @@
 
 # Compare two tables which are expected to be equal. Will only check columns defined on the left-hand table.
 # Useful when using online-schema-change tools to add columns or whatnot.
+#
+# The default "join" mode finds differences with one big LEFT OUTER JOIN, which is fine for small tables. The
+# "checksum" mode instead walks --id-column in chunks, comparing a checksum of each chunk on the two tables and
+# bisecting the chunks which differ until they're small enough to compare row by row, so the cost is
+# proportional to the number of differences rather than the size of the tables. Chunks can be spread over several
+# worker connections (and replicas), throttled, and paused while the servers are lagging or busy.
+#
+# The "merge" mode compares tables on two different servers: it streams both in --id-column order and merge-joins
+# them on the client, so memory use is bounded by --batch-size whatever the size of the tables.
 
 import argparse
+import base64
+import collections
+import datetime
+import decimal
+import json
 import os.path
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import MySQLdb
 import MySQLdb.cursors
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--id-column', default='id', help='Name of ID column (default %(default)s)')
-    parser.add_argument('--limit', type=int, default=1000, help='Limit of number of differences to show')
-    parser.add_argument('database')
-    parser.add_argument('table1')
-    parser.add_argument('table2')
-    args = parser.parse_args()
+Difference = collections.namedtuple('Difference', ['row_id', 'lhs', 'rhs'])
+
+
+def quote(name):
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
+def changed_columns(columns, lhs, rhs):
+    """Return {column: (lhs value, rhs value)} for the columns which differ between two rows"""
+    return dict((col, (lhs[col], rhs.get(col))) for col in columns if lhs[col] != rhs.get(col))
+
 
-    conn = MySQLdb.connect(
-        read_default_file=os.path.expanduser('~/.my.cnf'), db=args.database,
-        cursorclass=MySQLdb.cursors.DictCursor
+def fetch_by_ids(c, table, id_column, ids):
+    c.execute('SELECT * FROM {table} WHERE {id} IN ({placeholders})'.format(
+        table=quote(table), id=quote(id_column), placeholders=', '.join(['%s'] * len(ids))
+    ), list(ids))
+    return dict((row[id_column], row) for row in c)
+
+
+def connect(args, host=None, database=None):
+    """Connect using ~/.my.cnf, optionally to a different host:port or database"""
+    kwargs = {}
+    if host is not None:
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            kwargs['port'] = int(port)
+        kwargs['host'] = host
+    return MySQLdb.connect(
+        read_default_file=os.path.expanduser('~/.my.cnf'), db=database or args.database,
+        cursorclass=MySQLdb.cursors.DictCursor, **kwargs
     )
 
-    c = conn.cursor()
-    c.execute('SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME=%s', (args.table1,))
-    all_columns = [r['COLUMN_NAME'] for r in c]
-    if args.id_column not in all_columns:
-        parser.error('--id-column must be present on source table')
 
+class RateLimit(object):
+    """Spaces out calls from every thread so there are at most rate per second in total"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            now = time.time()
+            when = max(self.next_time, now)
+            self.next_time = when + self.interval
+        if when > now:
+            time.sleep(when - now)
+
+
+class LoadMonitor(object):
+    """Watches replica lag and Threads_running on some servers, and holds everyone up while either is too high"""
+
+    def __init__(self, args, hosts, max_lag, max_threads_running, interval):
+        self.args = args
+        self.hosts = hosts
+        self.max_lag = max_lag
+        self.max_threads_running = max_threads_running
+        self.interval = interval
+        self.conns = {}
+        self.ok = threading.Event()
+        self.ok.set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def wait(self):
+        self.ok.wait()
+
+    def _check(self, host):
+        """Return why host is too busy, or None if it's fine"""
+        if host not in self.conns:
+            self.conns[host] = connect(self.args, host)
+        c = self.conns[host].cursor()
+        if self.max_lag is not None:
+            c.execute('SHOW SLAVE STATUS')
+            status = c.fetchone()
+            if status is not None:
+                lag = status.get('Seconds_Behind_Master')
+                if lag is None:
+                    return 'replication is not running'
+                if lag > self.max_lag:
+                    return 'replica is {0}s behind'.format(lag)
+        if self.max_threads_running is not None:
+            c.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+            threads_running = int(c.fetchone()['Value'])
+            if threads_running > self.max_threads_running:
+                return 'Threads_running is {0}'.format(threads_running)
+        return None
+
+    def _run(self):
+        while True:
+            reasons = []
+            for host in self.hosts:
+                try:
+                    reason = self._check(host)
+                except MySQLdb.Error as e:
+                    # if we can't tell, assume the worst
+                    self.conns.pop(host, None)
+                    reason = 'check failed: {0}'.format(e)
+                if reason is not None:
+                    reasons.append('{0}: {1}'.format(host or 'default', reason))
+            if reasons:
+                if self.ok.is_set():
+                    sys.stderr.write('pausing: {0}\n'.format('; '.join(reasons)))
+                self.ok.clear()
+            elif not self.ok.is_set():
+                sys.stderr.write('resuming\n')
+                self.ok.set()
+            time.sleep(self.interval)
+
+
+class ChunkedComparison(object):
+    """Compares two tables a range of ids at a time
+
+    A range is (lo, hi], with None meaning unbounded, so the first and last chunks also pick up any rows on
+    the right-hand table which are outside the ids on the left.
+    """
+
+    def __init__(self, conn, table1, table2, id_column, columns, chunk_size, bisect_threshold, throttle=None):
+        self.conn = conn
+        # called before every query
+        self.throttle = throttle
+        self.tables = (table1, table2)
+        self.id_column = id_column
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.bisect_threshold = bisect_threshold
+        # CONCAT_WS skips NULLs, so also checksum which columns were NULL to tell NULL from ''
+        self.checksum_expr = "COALESCE(BIT_XOR(CRC32(CONCAT_WS('#', {0}, CONCAT({1})))), 0)".format(
+            ', '.join(quote(col) for col in columns),
+            ', '.join('ISNULL({0})'.format(quote(col)) for col in columns),
+        )
+
+    def _execute(self, c, query, params):
+        if self.throttle is not None:
+            self.throttle()
+        c.execute(query, params)
+
+    def _where(self, lo, hi):
+        clauses = []
+        params = []
+        if lo is not None:
+            clauses.append('{0} > %s'.format(quote(self.id_column)))
+            params.append(lo)
+        if hi is not None:
+            clauses.append('{0} <= %s'.format(quote(self.id_column)))
+            params.append(hi)
+        return ' AND '.join(clauses) or '1=1', params
+
+    def chunks(self):
+        """Split the left-hand table into ranges of about chunk_size rows"""
+        c = self.conn.cursor()
+        lo = None
+        while True:
+            where, params = self._where(lo, None)
+            self._execute(c, 'SELECT {id} AS boundary FROM {table} WHERE {where} ORDER BY {id} LIMIT %s, 1'.format(
+                id=quote(self.id_column), table=quote(self.tables[0]), where=where
+            ), params + [self.chunk_size - 1])
+            row = c.fetchone()
+            # don't hold a snapshot open for the whole walk
+            self.conn.rollback()
+            if row is None:
+                yield lo, None
+                return
+            yield lo, row['boundary']
+            lo = row['boundary']
+
+    def checksum(self, table, lo, hi):
+        c = self.conn.cursor()
+        where, params = self._where(lo, hi)
+        self._execute(c, 'SELECT COUNT(*) AS count, {checksum} AS checksum FROM {table} WHERE {where}'.format(
+            checksum=self.checksum_expr, table=quote(table), where=where
+        ), params)
+        row = c.fetchone()
+        return row['count'], row['checksum']
+
+    def split(self, table, lo, hi, count):
+        """Return an id which splits (lo, hi] on table in half"""
+        c = self.conn.cursor()
+        where, params = self._where(lo, hi)
+        self._execute(c, 'SELECT {id} AS boundary FROM {table} WHERE {where} ORDER BY {id} LIMIT %s, 1'.format(
+            id=quote(self.id_column), table=quote(table), where=where
+        ), params + [count // 2 - 1])
+        return c.fetchone()['boundary']
+
+    def fetch_rows(self, table, lo, hi):
+        c = self.conn.cursor()
+        where, params = self._where(lo, hi)
+        self._execute(c, 'SELECT * FROM {table} WHERE {where}'.format(table=quote(table), where=where), params)
+        return dict((row[self.id_column], row) for row in c)
+
+    def compare_rows(self, lo, hi):
+        lhs_rows = self.fetch_rows(self.tables[0], lo, hi)
+        rhs_rows = self.fetch_rows(self.tables[1], lo, hi)
+        for row_id in sorted(set(lhs_rows) | set(rhs_rows)):
+            lhs = lhs_rows.get(row_id)
+            rhs = rhs_rows.get(row_id)
+            if lhs is None or rhs is None or changed_columns(self.columns, lhs, rhs):
+                yield Difference(row_id, lhs, rhs)
+
+    def compare_range(self, lo, hi, checksums=None):
+        """Yield the differences in (lo, hi], bisecting until the mismatched ranges are small"""
+        if checksums is None:
+            checksums = [self.checksum(table, lo, hi) for table in self.tables]
+        if checksums[0] == checksums[1]:
+            return
+        counts = [count for count, _ in checksums]
+        if max(counts) <= self.bisect_threshold:
+            for difference in self.compare_rows(lo, hi):
+                yield difference
+            return
+        # split on whichever side has more rows, since the other might have none at all
+        bigger = 0 if counts[0] >= counts[1] else 1
+        mid = self.split(self.tables[bigger], lo, hi, counts[bigger])
+        for half_lo, half_hi in ((lo, mid), (mid, hi)):
+            for difference in self.compare_range(half_lo, half_hi):
+                yield difference
+
+    def compare_chunk(self, lo, hi):
+        """Return the differences in a chunk, ending the transaction afterwards so as not to hold up purge"""
+        try:
+            return list(self.compare_range(lo, hi))
+        finally:
+            self.conn.rollback()
+
+
+_DONE = object()
+
+
+def chunked_differences(args, columns):
+    """Yield differences found by --workers threads, each with its own connection, working through the chunks"""
+    monitor = None
+    hosts = args.replica or [None]
+    if args.max_replica_lag is not None or args.max_threads_running is not None:
+        monitor = LoadMonitor(args, hosts, args.max_replica_lag, args.max_threads_running, args.check_interval)
+        monitor.start()
+    rate_limit = RateLimit(args.max_qps) if args.max_qps else None
+
+    def throttle():
+        if monitor is not None:
+            monitor.wait()
+        if rate_limit is not None:
+            rate_limit()
+
+    def comparison(conn):
+        return ChunkedComparison(
+            conn, args.table1, args.table2, args.id_column, columns, args.chunk_size, args.bisect_threshold, throttle
+        )
+
+    chunks = queue.Queue(maxsize=args.workers * 2)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def plan():
+        try:
+            for chunk in comparison(connect(args, hosts[0])).chunks():
+                while not stop.is_set():
+                    try:
+                        chunks.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            results.put(e)
+        finally:
+            for _ in range(args.workers):
+                chunks.put(_DONE)
+
+    def work(host):
+        try:
+            worker = comparison(connect(args, host))
+            while not stop.is_set():
+                chunk = chunks.get()
+                if chunk is _DONE:
+                    break
+                for difference in worker.compare_chunk(*chunk):
+                    results.put(difference)
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(_DONE)
+
+    threads = [threading.Thread(target=plan)]
+    for i in range(args.workers):
+        threads.append(threading.Thread(target=work, args=(hosts[i % len(hosts)],)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = args.workers
+    try:
+        while running:
+            try:
+                # poll so that KeyboardInterrupt gets delivered to the main thread on python 2
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if result is _DONE:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        stop.set()
+
+
+def join_differences(conn, args, all_columns):
+    c = conn.cursor()
     query = '''SELECT lhs.`{id_column}` AS identifier
 FROM `{table}` lhs
 LEFT OUTER JOIN `{rhs_table}` rhs ON lhs.`{id_column}` = rhs.`{id_column}`
@@ -40,27 +356,234 @@ LIMIT {limit}
         table=args.table1,
         rhs_table=args.table2,
         id_column=args.id_column,
-        where_clause=' OR '.join('lhs.`{col}` <> rhs.`{col}`'.format(col=col) for col in all_columns),
+        # <=> so that NULLs (including a missing rhs row) compare too
+        where_clause=' OR '.join('NOT (lhs.`{col}` <=> rhs.`{col}`)'.format(col=col) for col in all_columns),
         limit=args.limit
     )
 
     c.execute(query)
     mismatched_ids = [r['identifier'] for r in c]
-    print('Mismatched IDs: {0} (limit {1})'.format(mismatched_ids, args.limit))
 
-    for row_id in mismatched_ids:
-        c.execute('SELECT * FROM {table} WHERE {id_column}=%s'.format(
-            table=args.table1, id_column=args.id_column), (row_id)
-        )
-        lhs = c.fetchone()
-        c.execute('SELECT * FROM {table} WHERE {id_column}=%s'.format(
-            table=args.table2, id_column=args.id_column), (row_id)
-        )
-        rhs = c.fetchone()
-        print('ID: {0}'.format(row_id))
-        print('  LHS: {0!r}'.format(lhs))
-        print('  RHS: {0!r}'.format(rhs))
+    for i in range(0, len(mismatched_ids), args.fetch_batch_size):
+        batch = mismatched_ids[i:i + args.fetch_batch_size]
+        lhs_rows = fetch_by_ids(c, args.table1, args.id_column, batch)
+        rhs_rows = fetch_by_ids(c, args.table2, args.id_column, batch)
+        conn.rollback()
+        for row_id in batch:
+            yield Difference(row_id, lhs_rows.get(row_id), rhs_rows.get(row_id))
+
+
+def stream_table(conn, table, id_column, batch_size):
+    """Yield every row of table in id order, using keyset pagination and unbuffered cursors"""
+    last_id = None
+    while True:
+        c = conn.cursor(MySQLdb.cursors.SSDictCursor)
+        if last_id is None:
+            where, params = '', [batch_size]
+        else:
+            where, params = 'WHERE {0} > %s'.format(quote(id_column)), [last_id, batch_size]
+        c.execute('SELECT * FROM {table} {where} ORDER BY {id} LIMIT %s'.format(
+            table=quote(table), where=where, id=quote(id_column)
+        ), params)
+        rows = 0
+        for row in c:
+            rows += 1
+            last_id = row[id_column]
+            yield row
+        c.close()
+        # a fresh snapshot for every page, rather than one held open for the whole table
         conn.rollback()
+        if rows < batch_size:
+            return
+
+
+def merge_differences(args, columns):
+    """Merge-join table1 on --lhs-host with table2 on --rhs-host, both streamed in id order"""
+    id_column = args.id_column
+    lhs_rows = stream_table(connect(args, args.lhs_host), args.table1, id_column, args.batch_size)
+    rhs_rows = stream_table(connect(args, args.rhs_host, args.rhs_database), args.table2, id_column, args.batch_size)
+    lhs = next(lhs_rows, None)
+    rhs = next(rhs_rows, None)
+    while lhs is not None or rhs is not None:
+        if rhs is None or (lhs is not None and lhs[id_column] < rhs[id_column]):
+            yield Difference(lhs[id_column], lhs, None)
+            lhs = next(lhs_rows, None)
+        elif lhs is None or rhs[id_column] < lhs[id_column]:
+            yield Difference(rhs[id_column], None, rhs)
+            rhs = next(rhs_rows, None)
+        else:
+            if changed_columns(columns, lhs, rhs):
+                yield Difference(lhs[id_column], lhs, rhs)
+            lhs = next(lhs_rows, None)
+            rhs = next(rhs_rows, None)
+
+
+def _json_value(value):
+    # json.dumps would decode a python 2 str as UTF-8 before default ever saw it, so binary
+    # columns have to be dealt with up front
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'base64': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _json_row(row):
+    return dict((col, _json_value(value)) for col, value in row.items())
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, datetime.timedelta)):
+        return str(value)
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+def write_jsonl(out, columns, difference):
+    """One line per difference: changed rows only have their differing columns, missing rows the whole other row.
+
+    Values which aren't valid UTF-8 are written as {"base64": ...}."""
+    record = {'id': _json_value(difference.row_id)}
+    if difference.rhs is None:
+        record['status'] = 'left_only'
+        record['lhs'] = _json_row(difference.lhs)
+    elif difference.lhs is None:
+        record['status'] = 'right_only'
+        record['rhs'] = _json_row(difference.rhs)
+    else:
+        record['status'] = 'changed'
+        record['columns'] = dict(
+            (col, {'lhs': _json_value(lhs), 'rhs': _json_value(rhs)})
+            for col, (lhs, rhs) in changed_columns(columns, difference.lhs, difference.rhs).items()
+        )
+    out.write(json.dumps(record, sort_keys=True, default=_json_default) + '\n')
+    out.flush()
+
+
+def write_text(out, columns, difference):
+    out.write('ID: {0}\n'.format(difference.row_id))
+    out.write('  LHS: {0!r}\n'.format(difference.lhs))
+    out.write('  RHS: {0!r}\n'.format(difference.rhs))
+    if difference.lhs is not None and difference.rhs is not None:
+        for col, (lhs, rhs) in sorted(changed_columns(columns, difference.lhs, difference.rhs).items()):
+            out.write('  {0}: {1!r} -> {2!r}\n'.format(col, lhs, rhs))
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id-column', default='id', help='Name of ID column (default %(default)s)')
+    parser.add_argument('--limit', type=int, default=1000, help='Limit of number of differences to show')
+    parser.add_argument(
+        '--mode', choices=('join', 'checksum', 'merge'), default='join',
+        help=('Compare with one big join, chunk by chunk with checksums, or by streaming both tables and '
+              'merging them here (default %(default)s)')
+    )
+    parser.add_argument(
+        '--format', choices=('text', 'jsonl'), default='text',
+        help=('Write differences as readable text, or as one JSON object per line with just the changed columns '
+              '(default %(default)s)')
+    )
+    parser.add_argument(
+        '--fetch-batch-size', type=int, default=500,
+        help='In join mode, fetch mismatched rows this many ids at a time (default %(default)s)'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='In checksum mode, rows per chunk (default %(default)s)'
+    )
+    parser.add_argument(
+        '--bisect-threshold', type=int, default=100,
+        help='In checksum mode, compare mismatched chunks row by row once they are this small (default %(default)s)'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='In checksum mode, number of connections comparing chunks in parallel (default %(default)s)'
+    )
+    parser.add_argument(
+        '--replica', action='append', metavar='HOST[:PORT]',
+        help=('In checksum mode, spread the workers over these servers instead of the one in ~/.my.cnf; '
+              'may be given more than once')
+    )
+    parser.add_argument(
+        '--max-qps', type=float, default=None,
+        help='In checksum mode, run at most this many queries per second across all workers'
+    )
+    parser.add_argument(
+        '--max-replica-lag', type=float, default=None,
+        help='In checksum mode, pause while any of the servers is a replica more than this many seconds behind'
+    )
+    parser.add_argument(
+        '--max-threads-running', type=int, default=None,
+        help='In checksum mode, pause while any of the servers has more than this many Threads_running'
+    )
+    parser.add_argument(
+        '--check-interval', type=float, default=1.0,
+        help='How often to check --max-replica-lag and --max-threads-running, in seconds (default %(default)s)'
+    )
+    parser.add_argument(
+        '--lhs-host', metavar='HOST[:PORT]',
+        help='In merge mode, the server with table1 (default: the one in ~/.my.cnf)'
+    )
+    parser.add_argument(
+        '--rhs-host', metavar='HOST[:PORT]',
+        help='In merge mode, the server with table2 (default: the one in ~/.my.cnf)'
+    )
+    parser.add_argument(
+        '--rhs-database',
+        help='In merge mode, the database table2 is in (default: the same as table1)'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='In merge mode, rows to fetch per query from each table (default %(default)s)'
+    )
+    parser.add_argument('database')
+    parser.add_argument('table1')
+    parser.add_argument('table2')
+    args = parser.parse_args()
+    if args.chunk_size < 2 or args.bisect_threshold < 1:
+        parser.error('--chunk-size must be at least 2 and --bisect-threshold at least 1')
+    if args.workers < 1 or args.fetch_batch_size < 1 or args.batch_size < 1:
+        parser.error('--workers, --fetch-batch-size and --batch-size must be at least 1')
+
+    conn = connect(args, args.lhs_host if args.mode == 'merge' else None)
+
+    c = conn.cursor()
+    c.execute(
+        'SELECT COLUMN_NAME, COLLATION_NAME FROM INFORMATION_SCHEMA.COLUMNS '
+        'WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION',
+        (args.table1,)
+    )
+    collations = collections.OrderedDict((r['COLUMN_NAME'], r['COLLATION_NAME']) for r in c)
+    all_columns = list(collations)
+    if args.id_column not in all_columns:
+        parser.error('--id-column must be present on source table')
+    id_collation = collations[args.id_column]
+    if args.mode == 'merge' and id_collation is not None and not id_collation.endswith('_bin'):
+        # the merge compares ids here, so the server has to sort them the way python does
+        parser.error('--id-column must be numeric or binary-collated in merge mode, not {0}'.format(id_collation))
+
+    if args.mode == 'checksum':
+        differences = chunked_differences(args, all_columns)
+    elif args.mode == 'merge':
+        differences = merge_differences(args, all_columns)
+    else:
+        differences = join_differences(conn, args, all_columns)
+
+    # write differences out as soon as they're found
+    write = write_jsonl if args.format == 'jsonl' else write_text
+    found = []
+    for difference in differences:
+        write(sys.stdout, all_columns, difference)
+        found.append(difference.row_id)
+        if len(found) >= args.limit:
+            break
+    if args.format == 'jsonl':
+        sys.stderr.write('{0} mismatched IDs (limit {1})\n'.format(len(found), args.limit))
+    else:
+        print('Mismatched IDs: {0} (limit {1})'.format(found, args.limit))
 
 
 main()
@@ -1,24 +1,104 @@
 #!/usr/bin/python
 
 import argparse
+import collections
 import difflib
+import fnmatch
+import hashlib
+import multiprocessing
+import os
+import cPickle as pickle
 import re
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 
-_comment_re = re.compile(r'\s*#.*')
 _blank_re = re.compile(r'^\s*$')
-_start_block_re = re.compile(r'^(?P<type>\w+)( +(?P<name>[a-zA-Z0-9._-]+))?')
+_needs_shlex_re = re.compile(r'["\'\\]')
+_needs_quote_re = re.compile(r'[\s"\'\\#]')
+
+SECTION_KEYWORDS = frozenset([
+    'global', 'defaults', 'frontend', 'backend', 'listen', 'userlist', 'peers', 'resolvers', 'mailers',
+    'program', 'http-errors', 'ring', 'cache', 'log-forward', 'crt-store',
+])
+
+# rules which are evaluated in order against other rules with the same keyword
+ORDERED_KEYWORDS = frozenset([
+    'use_backend', 'use-server', 'redirect', 'block', 'reqadd', 'reqrep', 'reqdel', 'rspadd', 'rsprep', 'rspdel',
+    'http-request', 'http-response', 'http-after-response', 'tcp-request', 'tcp-response', 'stick', 'filter',
+])
+
+# directives which are settings named by their first argument (e.g. "timeout client 30s")
+NAMED_BY_FIRST_ARG = frozenset(['timeout', 'option', 'no', 'stats', 'errorfile', 'tune.ssl', 'http-check'])
+
+# server options which don't take a value
+SERVER_FLAGS = frozenset([
+    'agent-check', 'allow-0rtt', 'backup', 'check', 'check-send-proxy', 'check-ssl', 'check-via-socks4',
+    'disabled', 'enabled', 'force-sslv3', 'force-tlsv10', 'force-tlsv11', 'force-tlsv12', 'force-tlsv13',
+    'no-agent-check', 'no-backup', 'no-check', 'no-check-ssl', 'no-send-proxy', 'no-send-proxy-v2',
+    'no-send-proxy-v2-ssl', 'no-send-proxy-v2-ssl-cn', 'no-ssl', 'no-ssl-reuse', 'no-sslv3', 'no-tls-tickets',
+    'no-tlsv10', 'no-tlsv11', 'no-tlsv12', 'no-tlsv13', 'no-verifyhost', 'no-tfo', 'non-stick', 'send-proxy',
+    'send-proxy-v2', 'send-proxy-v2-ssl', 'send-proxy-v2-ssl-cn', 'ssl', 'ssl-reuse', 'stick', 'tfo',
+    'tls-tickets',
+])
+
+
+Directive = collections.namedtuple('Directive', ['keyword', 'args'])
+Server = collections.namedtuple('Server', ['name', 'address', 'options'])
+Change = collections.namedtuple('Change', ['kind', 'subject', 'detail'])
+
+
+def tokenize(line):
+    """Split a config line into words, dropping comments"""
+    if _needs_shlex_re.search(line):
+        lexer = shlex.shlex(line, posix=True)
+        lexer.whitespace_split = True
+        lexer.commenters = '#'
+        return list(lexer)
+    return line.split('#', 1)[0].split()
+
+
+def parse_server_options(args):
+    """Split server (or default-server) options into (option, value) pairs"""
+    options = []
+    i = 0
+    while i < len(args):
+        if args[i] in SERVER_FLAGS or i + 1 == len(args):
+            options.append((args[i], None))
+            i += 1
+        else:
+            options.append((args[i], args[i + 1]))
+            i += 2
+    return tuple(options)
+
+
+def parse_server(directive):
+    """Split a server line's arguments into its name, address and (option, value) pairs"""
+    args = directive.args
+    return Server(args[0] if args else None, args[1] if len(args) > 1 else None, parse_server_options(args[2:]))
 
 
 class Block(object):
     def __init__(self, ty, name):
         self.ty = ty
         self.name = name
-        self.contents = set()
+        # everything except servers, in order
+        self.directives = []
+        self.servers = collections.OrderedDict()
+
+    def add(self, directive):
+        if directive.keyword == 'server' and directive.args:
+            self.servers[directive.args[0]] = parse_server(directive)
+        else:
+            self.directives.append(directive)
 
     @property
     def cmp_tuple(self):
-        return (self.ty, self.name, frozenset(self.contents))
+        return (self.ty, self.name, self.directives, self.servers)
 
     def __eq__(self, other):
         return self.cmp_tuple == other.cmp_tuple
@@ -42,62 +122,558 @@ def parse_config(fd):
     current = None
     for line in fd:
         line = line.rstrip()
-        line = _comment_re.sub('', line)
         if _blank_re.match(line):
             continue
-        smd = _start_block_re.match(line)
-        if smd:
+        words = tokenize(line)
+        if not words:
+            continue
+        if words[0] in SECTION_KEYWORDS or not line[0].isspace():
             if current:
                 blocks[current.key] = current
-            current = Block(smd.group('type'), smd.group('name'))
+            current = Block(words[0], words[1] if len(words) > 1 else None)
         else:
             if not current:
                 print line
-            current.contents.add(line.lstrip())
+                continue
+            current.add(Directive(words[0], tuple(words[1:])))
     if current:
         blocks[current.key] = current
     return blocks
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('lhs', type=argparse.FileType('r'), help='Left-hand-side file')
-    parser.add_argument('rhs', type=argparse.FileType('r'), help='Right-hand-side file')
-    args = parser.parse_args()
+def _quote(word):
+    if not word or _needs_quote_re.search(word):
+        return '"%s"' % word.replace('\\', '\\\\').replace('"', '\\"')
+    return word
+
+
+def format_directive(directive):
+    return ' '.join(_quote(w) for w in (directive.keyword,) + directive.args)
+
+
+def format_server(server):
+    words = [server.address or '']
+    for option, value in server.options:
+        words.append(option if value is None else '%s %s' % (option, value))
+    return ' '.join(words)
+
+
+def diff_servers(lservers, rservers):
+    changes = []
+    for name, server in lservers.iteritems():
+        if name not in rservers:
+            changes.append(Change('removed', 'server %s' % name, format_server(server)))
+    for name, rserver in rservers.iteritems():
+        lserver = lservers.get(name)
+        if lserver is None:
+            changes.append(Change('added', 'server %s' % name, format_server(rserver)))
+            continue
+        if lserver == rserver:
+            continue
+        details = []
+        if lserver.address != rserver.address:
+            details.append('address %s -> %s' % (lserver.address, rserver.address))
+        loptions = dict(lserver.options)
+        roptions = dict(rserver.options)
+        for option, value in lserver.options:
+            if option not in roptions:
+                details.append('%s removed' % option)
+            elif roptions[option] != value:
+                details.append('%s %s -> %s' % (option, value, roptions[option]))
+        for option, value in rserver.options:
+            if option not in loptions:
+                details.append('%s added' % option if value is None else '%s %s added' % (option, value))
+        if not details:
+            details.append('options reordered')
+        changes.append(Change('changed', 'server %s' % name, '; '.join(details)))
+    return changes
+
+
+def _setting_key(directive):
+    if directive.keyword in NAMED_BY_FIRST_ARG and directive.args:
+        return (directive.keyword, directive.args[0])
+    return (directive.keyword,)
+
+
+def _split_surplus(directives, matched, surplus):
+    """Split directives into the surplus copies, in order, and the rest.
+
+    At most min(lhs, rhs) copies of a directive can be matched, so there are always enough
+    unmatched copies to make up the surplus."""
+    surplus = surplus.copy()
+    extra = []
+    common = []
+    for i, d in enumerate(directives):
+        if surplus[d] > 0 and i not in matched:
+            surplus[d] -= 1
+            extra.append(d)
+        else:
+            common.append(d)
+    return extra, common
+
+
+def diff_directives(ldirectives, rdirectives):
+    changes = []
+    lcounts = collections.Counter(ldirectives)
+    rcounts = collections.Counter(rdirectives)
+    # only the extra copies of a duplicated directive were removed or added; which copies is
+    # decided by lining the sections up, so dropping one of two copies isn't also a reordering
+    lmatched = set()
+    rmatched = set()
+    if lcounts != rcounts:
+        for block in difflib.SequenceMatcher(None, ldirectives, rdirectives, autojunk=False).get_matching_blocks():
+            lmatched.update(xrange(block.a, block.a + block.size))
+            rmatched.update(xrange(block.b, block.b + block.size))
+    removed, lcommon = _split_surplus(ldirectives, lmatched, lcounts - rcounts)
+    added, rcommon = _split_surplus(rdirectives, rmatched, rcounts - lcounts)
+
+    # a setting which was removed and added with different values was changed
+    removed_by_key = collections.defaultdict(list)
+    added_by_key = collections.defaultdict(list)
+    for d in removed:
+        if d.keyword not in ORDERED_KEYWORDS:
+            removed_by_key[_setting_key(d)].append(d)
+    for d in added:
+        if d.keyword not in ORDERED_KEYWORDS:
+            added_by_key[_setting_key(d)].append(d)
+    paired = set()
+    for key, lds in removed_by_key.iteritems():
+        rds = added_by_key.get(key, [])
+        if len(lds) == 1 and len(rds) == 1:
+            changes.append(Change('changed', ' '.join(key), '%s -> %s' % (
+                ' '.join(_quote(w) for w in lds[0].args[len(key) - 1:]),
+                ' '.join(_quote(w) for w in rds[0].args[len(key) - 1:]),
+            )))
+            paired.update((lds[0], rds[0]))
+    changes.extend(Change('removed', format_directive(d), None) for d in removed if d not in paired)
+    changes.extend(Change('added', format_directive(d), None) for d in added if d not in paired)
+
+    # rules which are in both, but in a different order relative to the other rules with the same keyword
+    lrules = collections.defaultdict(list)
+    rrules = collections.defaultdict(list)
+    for d in lcommon:
+        if d.keyword in ORDERED_KEYWORDS:
+            lrules[d.keyword].append(d)
+    for d in rcommon:
+        if d.keyword in ORDERED_KEYWORDS:
+            rrules[d.keyword].append(d)
+    for keyword in sorted(rrules):
+        lseq, rseq = lrules[keyword], rrules[keyword]
+        if lseq == rseq:
+            continue
+        matcher = difflib.SequenceMatcher(None, lseq, rseq, autojunk=False)
+        kept = set()
+        for block in matcher.get_matching_blocks():
+            kept.update(range(block.b, block.b + block.size))
+        lpositions = {}
+        for i, d in enumerate(lseq):
+            lpositions.setdefault(d, i)
+        for i, d in enumerate(rseq):
+            if i not in kept:
+                changes.append(Change('reordered', format_directive(d), '%s #%d, was #%d' % (
+                    keyword, i + 1, lpositions[d] + 1
+                )))
+    return changes
+
+
+def diff_blocks(lblock, rblock):
+    """Return a list of Changes turning lblock into rblock"""
+    return diff_directives(lblock.directives, rblock.directives) + diff_servers(lblock.servers, rblock.servers)
+
+
+ConfigDiff = collections.namedtuple('ConfigDiff', ['changed', 'added', 'removed'])
+
+
+def diff_configs(lhs, rhs):
+    """Diff two parsed configs; changed maps each section key to its Changes"""
+    changed = {}
+    for key in set(lhs) & set(rhs):
+        if lhs[key] != rhs[key]:
+            changes = diff_blocks(lhs[key], rhs[key])
+            if changes:
+                changed[key] = changes
+    return ConfigDiff(changed, sorted(set(rhs) - set(lhs)), sorted(set(lhs) - set(rhs)))
+
+
+# bump when the parsed model changes so stale cache entries are ignored
+CACHE_VERSION = 1
+
+
+def read_directory(root, pattern):
+    """Return {relative path: contents} for every file under root matching pattern"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in fnmatch.filter(filenames, pattern):
+            path = os.path.join(dirpath, filename)
+            with open(path, 'r') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def read_git_tree(repo, rev, root, pattern):
+    """Return {path relative to root: contents} for every matching file under root at rev"""
+    ls_tree = subprocess.check_output(['git', '-C', repo, 'ls-tree', '-r', '-z', rev, '--', root or '.'])
+    blobs = []
+    for entry in ls_tree.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        _, kind, sha = info.split()
+        if kind == 'blob' and fnmatch.fnmatch(os.path.basename(path), pattern):
+            blobs.append((os.path.relpath(path, root or '.'), sha))
+    files = {}
+    if not blobs:
+        return files
+    cat_file = subprocess.Popen(
+        ['git', '-C', repo, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+    # write the requests from another thread: git blocks on a full stdout pipe until we read it
+    def feed():
+        cat_file.stdin.write(''.join('%s\n' % sha for _, sha in blobs))
+        cat_file.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    for path, sha in blobs:
+        header = cat_file.stdout.readline().split()
+        size = int(header[2])
+        files[path] = cat_file.stdout.read(size)
+        cat_file.stdout.read(1)
+    feeder.join()
+    if cat_file.wait() != 0:
+        raise subprocess.CalledProcessError(cat_file.returncode, 'git cat-file --batch')
+    return files
+
 
-    lhs = parse_config(args.lhs)
-    rhs = parse_config(args.rhs)
-
-    missing_in_lhs = set()
-    missing_in_rhs = set()
-    different = set()
-    for key in (set(lhs.keys()) | set(rhs.keys())):
-        if key in lhs and key in rhs:
-            lblock = lhs[key]
-            rblock = rhs[key]
-            if lblock != rblock:
-                different.add((lblock, rblock))
-        elif key in lhs:
-            missing_in_rhs.add(key)
-        elif key in rhs:
-            missing_in_lhs.add(key)
-    if different:
+class ParseCache(object):
+    """Pickled parse results on disk, keyed by a hash of the file contents"""
+    def __init__(self, directory):
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def digest(contents):
+        return hashlib.sha1('%d\0%s' % (CACHE_VERSION, contents)).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.directory, '%s.pickle' % digest)
+
+    def get(self, digest):
+        if not self.directory:
+            return None
+        # anything unreadable is a miss, including pickles of __main__.Block written when this
+        # was run as a script and now being loaded by something that imported it
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def put(self, digest, blocks):
+        if not self.directory:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(blocks, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path(digest))
+
+
+def _parse_text(contents):
+    return parse_config(contents.splitlines())
+
+
+def parse_files(files, cache, processes):
+    """Parse {name: contents} into {name: blocks}, only parsing contents which aren't cached"""
+    digests = dict((name, cache.digest(contents)) for name, contents in files.iteritems())
+    parsed = {}
+    todo = {}
+    for name, digest in digests.iteritems():
+        if digest in parsed or digest in todo:
+            continue
+        blocks = cache.get(digest)
+        if blocks is None:
+            todo[digest] = files[name]
+        else:
+            parsed[digest] = blocks
+    if todo:
+        items = todo.items()
+        if processes > 1 and len(items) > 1:
+            pool = multiprocessing.Pool(min(processes, len(items)))
+            try:
+                results = pool.map(_parse_text, [contents for _, contents in items], chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_parse_text(contents) for _, contents in items]
+        for (digest, _), blocks in zip(items, results):
+            cache.put(digest, blocks)
+            parsed[digest] = blocks
+    return dict((name, parsed[digest]) for name, digest in digests.iteritems())
+
+
+# srv_admin_state bits from haproxy's server.h
+SRV_ADMF_FMAINT = 0x01
+SRV_ADMF_CMAINT = 0x04
+SRV_ADMF_FDRAIN = 0x08
+
+
+def admin_command(path, command, timeout):
+    """Run one command against an haproxy admin socket and return its output"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(command + '\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return ''.join(chunks)
+
+
+def _runtime_server(row):
+    address = row['srv_addr']
+    if row.get('srv_fqdn', '-') != '-':
+        address = row['srv_fqdn']
+    if row.get('srv_port', '0') != '0':
+        address = '%s:%s' % (address, row['srv_port'])
+    admin = int(row['srv_admin_state'])
+    options = [('weight', row['srv_uweight'])]
+    if admin & SRV_ADMF_CMAINT:
+        options.append(('disabled', None))
+    if admin & SRV_ADMF_FMAINT:
+        options.append(('maint', None))
+    if admin & SRV_ADMF_FDRAIN:
+        options.append(('drain', None))
+    return Server(row['srv_name'], address, tuple(options))
+
+
+def read_runtime(path, timeout):
+    """Build Blocks for the backends and servers a running haproxy has, from its admin socket"""
+    blocks = {}
+    for line in admin_command(path, 'show backend', timeout).splitlines():
+        if line and not line.startswith('#'):
+            block = Block('backend', line.strip())
+            blocks[block.key] = block
+    columns = None
+    for line in admin_command(path, 'show servers state', timeout).splitlines():
+        if line.startswith('# '):
+            columns = line[2:].split()
+            continue
+        words = line.split()
+        if columns is None or len(words) < len(columns):
+            continue
+        row = dict(zip(columns, words))
+        key = ('backend', row['be_name'])
+        if key not in blocks:
+            blocks[key] = Block(*key)
+        blocks[key].servers[row['srv_name']] = _runtime_server(row)
+    return blocks
+
+
+def _default_server_options(block):
+    if block is None:
+        return ()
+    return sum((parse_server_options(d.args) for d in block.directives if d.keyword == 'default-server'), ())
+
+
+def _effective_options(*option_lists):
+    """Merge server options, later ones winning, the way default-server lines are applied"""
+    options = {}
+    for option_list in option_lists:
+        for option, value in option_list:
+            if option == 'enabled':
+                options.pop('disabled', None)
+            options[option] = value
+    return options
+
+
+def runtime_view(config):
+    """Reduce a parsed config to the backends and server settings which can be read from an admin socket"""
+    defaults = _default_server_options(config.get(('defaults', None)))
+    blocks = {}
+    for block in config.itervalues():
+        if block.ty not in ('backend', 'listen'):
+            continue
+        view = Block('backend', block.name)
+        block_defaults = _default_server_options(block)
+        for name, server in block.servers.iteritems():
+            options = _effective_options(defaults, block_defaults, server.options)
+            view_options = [('weight', options.get('weight', '1'))]
+            if 'disabled' in options:
+                view_options.append(('disabled', None))
+            view.servers[name] = Server(name, server.address, tuple(view_options))
+        blocks[view.key] = view
+    return blocks
+
+
+def diff_runtime(config, runtime):
+    """Diff the servers in a runtime_view of a config against what read_runtime found"""
+    changed = {}
+    for key in set(config) & set(runtime):
+        changes = diff_servers(config[key].servers, runtime[key].servers)
+        if changes:
+            changed[key] = changes
+    return ConfigDiff(changed, sorted(set(runtime) - set(config)), sorted(set(config) - set(runtime)))
+
+
+_CHANGE_MARKERS = {'added': '+', 'removed': '-', 'changed': '~', 'reordered': '^'}
+
+
+def print_diff(diff, lhs_name, rhs_name):
+    if diff.changed:
         print "Differences:"
-        for lblock, rblock in different:
+        for key in sorted(diff.changed):
             print
-            fromfile = "%s %s" % (args.lhs.name, str(lblock.key))
-            tofile = "%s %s" % (args.rhs.name, str(rblock.key))
-            for line in difflib.unified_diff(list(sorted(lblock.contents)), list(sorted(rblock.contents)), fromfile=fromfile, tofile=tofile):
-                print "\t%s" % line.rstrip()
-    if missing_in_rhs:
-        print "Removed in %s" % args.rhs.name
-        print "\n".join("\t%s" % str(r) for r in missing_in_rhs)
-    if missing_in_lhs:
-        print "Added in %s" % args.rhs.name
-        print "\n".join("\t%s" % str(l) for l in missing_in_lhs)
-    if not (different or missing_in_lhs or missing_in_rhs):
+            print "\t%s" % ' '.join(k for k in key if k)
+            for change in diff.changed[key]:
+                if change.detail:
+                    print "\t  %s %s: %s" % (_CHANGE_MARKERS[change.kind], change.subject, change.detail)
+                else:
+                    print "\t  %s %s" % (_CHANGE_MARKERS[change.kind], change.subject)
+    if diff.removed:
+        print "Removed in %s" % rhs_name
+        print "\n".join("\t%s" % str(r) for r in diff.removed)
+    if diff.added:
+        print "Added in %s" % rhs_name
+        print "\n".join("\t%s" % str(l) for l in diff.added)
+    if not (diff.changed or diff.added or diff.removed):
         print "No diffs! Congrats!"
 
 
+def diff_trees(lhs_files, rhs_files, rhs_name, cache, processes):
+    """Diff two {name: contents} trees, printing a per-file summary and then the details"""
+    # files which are identical or only on one side never need parsing
+    modified = [name for name in set(lhs_files) & set(rhs_files) if lhs_files[name] != rhs_files[name]]
+    parsed = parse_files(dict(
+        [(('lhs', name), lhs_files[name]) for name in modified] +
+        [(('rhs', name), rhs_files[name]) for name in modified]
+    ), cache, processes)
+    diffs = {}
+    for name in modified:
+        diff = diff_configs(parsed[('lhs', name)], parsed[('rhs', name)])
+        if diff.changed or diff.added or diff.removed:
+            diffs[name] = diff
+
+    print "Summary:"
+    for name in sorted(set(lhs_files) | set(rhs_files)):
+        if name not in rhs_files:
+            print "\tD %s" % name
+        elif name not in lhs_files:
+            print "\tA %s" % name
+        elif name in diffs:
+            diff = diffs[name]
+            print "\tM %s: %d sections changed, %d added, %d removed" % (
+                name, len(diff.changed), len(diff.added), len(diff.removed)
+            )
+    if not (diffs or set(lhs_files) ^ set(rhs_files)):
+        print "No diffs! Congrats!"
+        return
+    for name in sorted(diffs):
+        print
+        print "=== %s" % name
+        print_diff(diffs[name], name, '%s:%s' % (rhs_name, name))
+
+
+def diff_sockets(config, paths, timeout, concurrency):
+    """Diff config against the runtime state behind each admin socket, polling them concurrently"""
+    view = runtime_view(config)
+
+    def poll(path):
+        try:
+            return path, read_runtime(path, timeout), None
+        except (socket.error, ValueError, KeyError) as e:
+            return path, None, e
+
+    pool = ThreadPool(max(1, min(concurrency, len(paths))))
+    try:
+        results = pool.map(poll, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    diffs = {}
+    errors = 0
+    print "Summary:"
+    for path, runtime, error in results:
+        if error is not None:
+            errors += 1
+            print "\tE %s: %s" % (path, error)
+            continue
+        diff = diff_runtime(view, runtime)
+        if diff.changed or diff.added or diff.removed:
+            diffs[path] = diff
+            print "\tM %s: %d backends drifted, %d added, %d removed" % (
+                path, len(diff.changed), len(diff.added), len(diff.removed)
+            )
+    if not (diffs or errors):
+        print "No drift! Congrats!"
+    for path in sorted(diffs):
+        print
+        print "=== %s" % path
+        print_diff(diffs[path], 'config', path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lhs', help='Left-hand-side file or directory (or git revision, with --git)')
+    parser.add_argument(
+        'rhs', nargs='?', default=None, help='Right-hand-side file or directory (or git revision, with --git)'
+    )
+    parser.add_argument('--git', metavar='REPO', default=None, help='Diff the config trees at two revisions of REPO')
+    parser.add_argument('--path', default='', help='Subdirectory of the repository to diff, with --git')
+    parser.add_argument('--pattern', default='*.cfg', help='Config files to diff in trees (default %(default)s)')
+    parser.add_argument(
+        '--processes', type=int, default=multiprocessing.cpu_count(),
+        help='Processes to parse files with (default %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-dir', default=os.path.expanduser('~/.cache/diff_haproxy_config'),
+        help='Where to cache parsed files, or empty to disable (default %(default)s)'
+    )
+    parser.add_argument(
+        '--socket', dest='sockets', metavar='PATH', action='append', default=[],
+        help='Diff lhs against the running state behind this haproxy admin socket (may be repeated)'
+    )
+    parser.add_argument(
+        '--socket-timeout', type=float, default=5.0, help='Timeout for admin socket commands (default %(default)s)'
+    )
+    parser.add_argument(
+        '--socket-concurrency', type=int, default=32, help='Admin sockets to poll at once (default %(default)s)'
+    )
+    args = parser.parse_args()
+    if bool(args.sockets) == bool(args.rhs):
+        parser.error('pass either rhs or --socket')
+
+    if args.sockets:
+        with open(args.lhs, 'r') as f:
+            config = parse_config(f)
+        diff_sockets(config, args.sockets, args.socket_timeout, args.socket_concurrency)
+    elif args.git:
+        cache = ParseCache(args.cache_dir)
+        lhs_files = read_git_tree(args.git, args.lhs, args.path, args.pattern)
+        rhs_files = read_git_tree(args.git, args.rhs, args.path, args.pattern)
+        diff_trees(lhs_files, rhs_files, args.rhs, cache, args.processes)
+    elif os.path.isdir(args.lhs) and os.path.isdir(args.rhs):
+        cache = ParseCache(args.cache_dir)
+        lhs_files = read_directory(args.lhs, args.pattern)
+        rhs_files = read_directory(args.rhs, args.pattern)
+        diff_trees(lhs_files, rhs_files, args.rhs, cache, args.processes)
+    else:
+        with open(args.lhs, 'r') as f:
+            lhs = parse_config(f)
+        with open(args.rhs, 'r') as f:
+            rhs = parse_config(f)
+        print_diff(diff_configs(lhs, rhs), args.lhs, args.rhs)
+
+
 if __name__ == '__main__':
     main()
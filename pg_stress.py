@@ -1,67 +1,855 @@
 from __future__ import print_function
 
 import argparse
+import bisect
 import collections
+import heapq
+import itertools
 import json
+import math
 import mmap
 import time
 import struct
 import random
+import re
+import resource
+import select
 import sys
 import os
 
 import psycopg2
+import psycopg2.extensions
 
-PER_PROCESS_SHM_SIZE = 102400
+# Each child's shm slot starts with a length-prefixed JSON blob of results, written once at
+# the end. After that comes the live section, which the child keeps up to date while it
+# runs: a sequence number, the LIVE_COUNTERS, one latency histogram per query and one
+# for connecting. The child bumps the sequence number to odd before touching the live
+# section and back to even afterwards, so the parent can take a consistent snapshot
+# without any locks by retrying until it sees the same even number before and after
+# copying (a seqlock).
+RESULT_SIZE = 4096
+LIVE_COUNTERS = ('attempted', 'good', 'errors', 'late', 'missed', 'connects', 'connect_errors')
+LIVE_HEADER_FORMAT = '@Q%dQ' % len(LIVE_COUNTERS)
+LIVE_HEADER_SIZE = struct.calcsize(LIVE_HEADER_FORMAT)
 
-QUERIES = (
-    "SELECT id, name FROM user_tags WHERE id=%s",
-    "SELECT usersid, email FROM users WHERE usersid=%s",
-    #"SELECT usersid, notes FROM users WHERE email LIKE '%%%s%%'",
-)
+# Latencies go in log-linear (HDR-style) histograms of microseconds. Values under
+# HISTOGRAM_SUB_BUCKETS get a bucket each; above that, each power of two is split into
+# HISTOGRAM_SUB_BUCKETS / 2 buckets, so a bucket is never more than ~1.6% wide. The top
+# bucket starts at about 38 hours. The last slot holds the exact max.
+HISTOGRAM_PRECISION = 7
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_PRECISION
+HISTOGRAM_HALF = HISTOGRAM_SUB_BUCKETS // 2
+HISTOGRAM_MAX_SHIFT = 30
+HISTOGRAM_BUCKETS = HISTOGRAM_SUB_BUCKETS + HISTOGRAM_MAX_SHIFT * HISTOGRAM_HALF
+HISTOGRAM_FORMAT = '@%dQ' % (HISTOGRAM_BUCKETS + 1)
+HISTOGRAM_SIZE = struct.calcsize(HISTOGRAM_FORMAT)
+PERCENTILES = (50, 90, 99, 99.9)
 
+# simple sends each query as-is; prepared PREPAREs every query once per connection and
+# EXECUTEs it after that; batched sends all of a transaction's queries in one round trip
+MODES = ('simple', 'prepared', 'batched')
 
-def gen_query(some_integer):
-    return QUERIES[some_integer % len(QUERIES)], (some_integer,)
+# Used when there's no --workload: alternate between these, each child walking through
+# its own block of 2000 ids, rolling back every 4 queries
+DEFAULT_WORKLOAD = {
+    'mix': 'round_robin',
+    'queries': [
+        {
+            'sql': "SELECT id, name FROM user_tags WHERE id=%s",
+            'params': [{'type': 'sequential', 'stride': 2000}],
+        },
+        {
+            'sql': "SELECT usersid, email FROM users WHERE usersid=%s",
+            'params': [{'type': 'sequential', 'stride': 2000}],
+        },
+        #{
+        #    'sql': "SELECT usersid, notes FROM users WHERE email LIKE '%%%s%%'",
+        #    'params': [{'type': 'sequential', 'stride': 2000}],
+        #},
+    ],
+    'transactions': [{'steps': ['*'] * 4, 'end': 'rollback'}],
+}
 
 
-def runner(child_number, shm, args):
-    random.seed()
-    my_random_sleep = random.random() * args.sleep_time / 1000.0
+class Histogram(object):
+    def __init__(self, counts=None, max_us=0):
+        self.counts = counts if counts is not None else [0] * HISTOGRAM_BUCKETS
+        self.max_us = max_us
+
+    @staticmethod
+    def bucket_for(value_us):
+        if value_us < HISTOGRAM_SUB_BUCKETS:
+            return value_us
+        shift = value_us.bit_length() - HISTOGRAM_PRECISION
+        bucket = HISTOGRAM_SUB_BUCKETS + (shift - 1) * HISTOGRAM_HALF + (value_us >> shift) - HISTOGRAM_HALF
+        return min(bucket, HISTOGRAM_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_range(bucket):
+        """Return the smallest and largest values (in microseconds) which land in bucket"""
+        if bucket < HISTOGRAM_SUB_BUCKETS:
+            return bucket, bucket
+        shift, sub_bucket = divmod(bucket - HISTOGRAM_SUB_BUCKETS, HISTOGRAM_HALF)
+        shift += 1
+        low = (sub_bucket + HISTOGRAM_HALF) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, seconds):
+        value_us = int(seconds * 1000000)
+        self.counts[self.bucket_for(value_us)] += 1
+        self.max_us = max(self.max_us, value_us)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.max_us = max(self.max_us, other.max_us)
+
+    def since(self, earlier):
+        """Return what was recorded between an earlier snapshot of this histogram and now"""
+        counts = [a - b for a, b in zip(self.counts, earlier.counts)]
+        max_us = 0
+        for bucket in range(len(counts) - 1, -1, -1):
+            if counts[bucket]:
+                max_us = min(self.bucket_range(bucket)[1], self.max_us)
+                break
+        return Histogram(counts, max_us)
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def _value(self, bucket):
+        low, high = self.bucket_range(bucket)
+        return min((low + high) / 2.0, self.max_us)
+
+    def percentile(self, pct):
+        """Return the pct-th percentile in microseconds, to within a bucket"""
+        total = self.total
+        if not total:
+            return None
+        rank = max(1, int(math.ceil(total * pct / 100.0)))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self._value(bucket)
+
+    def mean(self):
+        total = self.total
+        if not total:
+            return None
+        return sum(self._value(bucket) * count for bucket, count in enumerate(self.counts) if count) / total
+
+    def summary_ms(self):
+        rv = {'count': self.total, 'max': self.max_us / 1000.0}
+        if rv['count']:
+            rv['mean'] = self.mean() / 1000.0
+            for pct in PERCENTILES:
+                rv['p%s' % pct] = self.percentile(pct) / 1000.0
+        return rv
+
+    def pack_into(self, buf, offset):
+        struct.pack_into(HISTOGRAM_FORMAT, buf, offset, *(self.counts + [self.max_us]))
+
+    @classmethod
+    def unpack_from(cls, buf, offset):
+        values = list(struct.unpack_from(HISTOGRAM_FORMAT, buf, offset))
+        return cls(values[:-1], values[-1])
+
+
+class Layout(object):
+    """Where things live in the shm segment, which has one slot per child"""
+
+    def __init__(self, num_queries):
+        self.num_queries = num_queries
+        # the connect histogram goes after the query ones
+        self.connect_index = num_queries
+        self.live_size = LIVE_HEADER_SIZE + (num_queries + 1) * HISTOGRAM_SIZE
+        pages = int(math.ceil(float(RESULT_SIZE + self.live_size) / mmap.PAGESIZE))
+        self.slot_size = pages * mmap.PAGESIZE
+
+    def result_offset(self, child_number):
+        return child_number * self.slot_size
+
+    def live_offset(self, child_number):
+        return self.result_offset(child_number) + RESULT_SIZE
+
+    def histogram_offset(self, child_number, query_number):
+        return self.live_offset(child_number) + LIVE_HEADER_SIZE + query_number * HISTOGRAM_SIZE
+
+
+class Recorder(object):
+    """A child's counters and histograms, published live to its shm slot"""
+
+    def __init__(self, shm, layout, child_number):
+        self.shm = shm
+        self.layout = layout
+        self.child_number = child_number
+        self.offset = layout.live_offset(child_number)
+        self.seq = 0
+        self.counters = [0] * len(LIVE_COUNTERS)
+        self.histograms = [Histogram() for _ in range(layout.num_queries + 1)]
+        self._begin()
+        for query_number, histogram in enumerate(self.histograms):
+            histogram.pack_into(shm, layout.histogram_offset(child_number, query_number))
+        self._end()
+
+    def _begin(self):
+        self.seq += 1
+        struct.pack_into('@Q', self.shm, self.offset, self.seq)
+
+    def _end(self):
+        struct.pack_into('@%dQ' % len(LIVE_COUNTERS), self.shm, self.offset + 8, *self.counters)
+        self.seq += 1
+        struct.pack_into('@Q', self.shm, self.offset, self.seq)
+
+    def count(self, name, n=1):
+        self._begin()
+        self.counters[LIVE_COUNTERS.index(name)] += n
+        self._end()
+
+    def record(self, query_number, seconds, rows):
+        """Record one query; only the bucket it landed in needs to be rewritten"""
+        self._begin()
+        self.counters[0] += 1
+        self.counters[1] += rows
+        self._record(query_number, seconds)
+        self._end()
+
+    def record_connect(self, seconds):
+        self._begin()
+        self.counters[LIVE_COUNTERS.index('connects')] += 1
+        self._record(self.layout.connect_index, seconds)
+        self._end()
+
+    def _record(self, query_number, seconds):
+        histogram = self.histograms[query_number]
+        value_us = int(seconds * 1000000)
+        bucket = Histogram.bucket_for(value_us)
+        histogram.counts[bucket] += 1
+        histogram.max_us = max(histogram.max_us, value_us)
+        base = self.layout.histogram_offset(self.child_number, query_number)
+        struct.pack_into('@Q', self.shm, base + bucket * 8, histogram.counts[bucket])
+        struct.pack_into('@Q', self.shm, base + HISTOGRAM_BUCKETS * 8, histogram.max_us)
 
-    if random.random() < args.idle_fraction:
-        idle = True
+
+def read_live(shm, layout, child_number):
+    """Take a consistent snapshot of a child's live section; returns (counters, histograms)"""
+    offset = layout.live_offset(child_number)
+    # a child killed halfway through an update leaves seq odd forever, so don't spin
+    # on it indefinitely; at worst one bucket is off by one
+    for _ in range(1000):
+        seq = struct.unpack_from('@Q', shm, offset)[0]
+        if seq % 2:
+            time.sleep(0)
+            continue
+        data = shm[offset:offset + layout.live_size]
+        if struct.unpack_from('@Q', shm, offset)[0] == seq:
+            break
     else:
-        idle = False
+        data = shm[offset:offset + layout.live_size]
+    values = struct.unpack_from(LIVE_HEADER_FORMAT, data, 0)
+    counters = dict(zip(LIVE_COUNTERS, values[1:]))
+    histograms = [
+        Histogram.unpack_from(data, LIVE_HEADER_SIZE + query_number * HISTOGRAM_SIZE)
+        for query_number in range(layout.num_queries + 1)
+    ]
+    return counters, histograms
+
+
+def snapshot(shm, layout, child_numbers):
+    """Sum up the live sections of a bunch of children; returns (counters, query histograms, connect histogram)"""
+    counters = collections.Counter()
+    histograms = [Histogram() for _ in range(layout.num_queries + 1)]
+    for child_number in child_numbers:
+        child_counters, child_histograms = read_live(shm, layout, child_number)
+        counters.update(child_counters)
+        for histogram, child_histogram in zip(histograms, child_histograms):
+            histogram.merge(child_histogram)
+    return counters, histograms[:-1], histograms[-1]
+
+
+class Reporter(object):
+    """Print per-interval throughput and latency, and optionally write it to a CSV or JSON lines file"""
+
+    FIELDS = (
+        'mode', 'elapsed', 'qps', 'attempted', 'good', 'errors', 'late', 'missed',
+        'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+        'connects', 'connect_errors', 'connect_p50_ms', 'connect_p99_ms',
+    )
+
+    def __init__(self, start, mode, output=None, output_format='csv', sampler=None):
+        self.start = start
+        self.mode = mode
+        self.sampler = sampler
+        self.fields = self.FIELDS + (tuple('server_' + f for f in ServerSampler.FIELDS) if sampler else ())
+        self.last_time = start
+        self.last_counters = collections.Counter()
+        self.last_histogram = Histogram()
+        self.last_connect = Histogram()
+        self.output = output
+        self.output_format = output_format
+        if output is not None and output_format == 'csv' and not output.tell():
+            output.write(','.join(self.fields) + '\n')
+
+    def sample(self, counters, histograms, connect):
+        now = time.time()
+        overall = Histogram()
+        for histogram in histograms:
+            overall.merge(histogram)
+        interval = overall.since(self.last_histogram)
+        elapsed = now - self.last_time
+        row = {
+            'mode': self.mode,
+            'elapsed': round(now - self.start, 3),
+            'qps': (counters['attempted'] - self.last_counters['attempted']) / max(elapsed, 1e-6),
+            'attempted': counters['attempted'] - self.last_counters['attempted'],
+            'good': counters['good'] - self.last_counters['good'],
+            'errors': counters['errors'] - self.last_counters['errors'],
+            'late': counters['late'] - self.last_counters['late'],
+            'missed': counters['missed'] - self.last_counters['missed'],
+            'max_ms': interval.max_us / 1000.0,
+            'connects': counters['connects'] - self.last_counters['connects'],
+            'connect_errors': counters['connect_errors'] - self.last_counters['connect_errors'],
+        }
+        for pct in (50, 90, 99):
+            value = interval.percentile(pct)
+            row['p%d_ms' % pct] = None if value is None else value / 1000.0
+        connect_interval = connect.since(self.last_connect)
+        for pct in (50, 99):
+            value = connect_interval.percentile(pct)
+            row['connect_p%d_ms' % pct] = None if value is None else value / 1000.0
+        self.last_time = now
+        self.last_counters = counters
+        self.last_histogram = overall
+        self.last_connect = connect
+        if self.sampler is not None:
+            # a broken sampler shouldn't take the run (and its children) down with it
+            try:
+                server = self.sampler.sample()
+            except Exception as e:
+                print('server sample failed: %s' % e, file=sys.stderr)
+                server = {}
+            for field in ServerSampler.FIELDS:
+                row['server_' + field] = server.get(field)
+        self.emit(row)
+        return row
+
+    def emit(self, row):
+        line = '[%7.1fs] %8.1f qps %6d errors %6d late %6d missed  p50 %s  p90 %s  p99 %s  max %s (ms)' % (
+            row['elapsed'], row['qps'], row['errors'], row['late'], row['missed'],
+            _fmt_ms(row['p50_ms']), _fmt_ms(row['p90_ms']), _fmt_ms(row['p99_ms']), _fmt_ms(row['max_ms']),
+        )
+        if row['connects'] or row['connect_errors']:
+            line += '  %d connects %d failed p50 %s p99 %s (ms)' % (
+                row['connects'], row['connect_errors'], _fmt_ms(row['connect_p50_ms']), _fmt_ms(row['connect_p99_ms']),
+            )
+        print(line)
+        if self.sampler is not None:
+            print('%11s %3s backends %3s active %3s idle-in-tx, waiting on %3s locks %3s lwlocks %3s io, '
+                  '%s commits/s, %s%% cache hits, load %s, %s%% cpu, %s cs/s' % (
+                      'server:', _fmt(row['server_backends']), _fmt(row['server_active']),
+                      _fmt(row['server_idle_in_transaction']), _fmt(row['server_waiting_lock']),
+                      _fmt(row['server_waiting_lwlock']), _fmt(row['server_waiting_io']),
+                      _fmt(row['server_commits_per_s'], '%.0f'), _fmt(row['server_cache_hit_pct'], '%.1f'),
+                      _fmt(row['server_load1'], '%.2f'), _fmt(row['server_cpu_busy_pct'], '%.0f'),
+                      _fmt(row['server_context_switches_per_s'], '%.0f'),
+                  ))
+            if row['server_statements_per_s'] is not None:
+                print('%11s %s statements/s, %s ms mean execution' % (
+                    '', _fmt(row['server_statements_per_s'], '%.0f'), _fmt(row['server_statement_mean_ms'], '%.3f'),
+                ))
+        if self.output is not None:
+            if self.output_format == 'json':
+                self.output.write(json.dumps(row, sort_keys=True) + '\n')
+            else:
+                self.output.write(','.join('' if row[f] is None else str(row[f]) for f in self.fields) + '\n')
+            self.output.flush()
+
+
+class ServerSampler(object):
+    """Polls the server's own statistics (and this host's) on a separate connection
+
+    Each sample is a flat dict: gauges for pg_stat_activity and the load average, and
+    per-second rates over the interval for the cumulative pg_stat_database,
+    pg_stat_statements and /proc/stat counters. pg_stat_statements is skipped if the
+    extension isn't installed, and the /proc numbers are only interesting when the
+    database is on this host.
+    """
+
+    FIELDS = (
+        'backends', 'active', 'idle_in_transaction', 'waiting_lock', 'waiting_lwlock', 'waiting_io',
+        'commits_per_s', 'rollbacks_per_s', 'cache_hit_pct', 'deadlocks', 'temp_bytes_per_s',
+        'statements_per_s', 'statement_mean_ms', 'load1', 'cpu_busy_pct', 'context_switches_per_s',
+    )
+
+    DATABASE_COUNTERS = ('xact_commit', 'xact_rollback', 'blks_read', 'blks_hit', 'deadlocks', 'temp_bytes')
+
+    def __init__(self, dsn):
+        self.conn = psycopg2.connect(dsn)
+        self.conn.autocommit = True
+        cur = self.conn.cursor()
+        cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+        self.statements_time_column = None
+        if cur.fetchall():
+            cur.execute("SELECT * FROM pg_stat_statements LIMIT 0")
+            columns = [column[0] for column in cur.description]
+            # renamed in postgres 13
+            self.statements_time_column = 'total_exec_time' if 'total_exec_time' in columns else 'total_time'
+        self.last_time = time.time()
+        self.last_counters = self._counters()
+
+    def _counters(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT %s FROM pg_stat_database WHERE datname = current_database()" % ', '.join(self.DATABASE_COUNTERS)
+        )
+        counters = dict(zip(self.DATABASE_COUNTERS, cur.fetchone()))
+        if self.statements_time_column is not None:
+            cur.execute(
+                # sum(bigint) is numeric, which psycopg2 hands back as a Decimal
+                "SELECT coalesce(sum(calls), 0)::bigint, coalesce(sum(%s), 0)::float8 FROM pg_stat_statements"
+                % self.statements_time_column
+            )
+            counters['calls'], counters['statement_time'] = cur.fetchone()
+        with open('/proc/stat') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == 'cpu':
+                    times = [int(value) for value in fields[1:]]
+                    # idle and iowait
+                    counters['cpu_idle'] = times[3] + times[4]
+                    counters['cpu_total'] = sum(times)
+                elif fields[0] == 'ctxt':
+                    counters['ctxt'] = int(fields[1])
+        return counters
+
+    def sample(self):
+        try:
+            cur = self.conn.cursor()
+            cur.execute(
+                "SELECT count(*), "
+                "count(*) FILTER (WHERE state = 'active'), "
+                "count(*) FILTER (WHERE state LIKE 'idle in transaction%%'), "
+                "count(*) FILTER (WHERE wait_event_type = 'Lock'), "
+                "count(*) FILTER (WHERE wait_event_type = 'LWLock'), "
+                "count(*) FILTER (WHERE wait_event_type = 'IO') "
+                "FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+            )
+            row = dict(zip(self.FIELDS[:6], cur.fetchone()))
+            counters = self._counters()
+        except psycopg2.Error as e:
+            print('server sample failed: %s' % e, file=sys.stderr)
+            return {}
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-6)
+        delta = dict((key, counters[key] - self.last_counters[key]) for key in counters)
+        row['commits_per_s'] = delta['xact_commit'] / elapsed
+        row['rollbacks_per_s'] = delta['xact_rollback'] / elapsed
+        blocks = delta['blks_read'] + delta['blks_hit']
+        row['cache_hit_pct'] = 100.0 * delta['blks_hit'] / blocks if blocks else None
+        row['deadlocks'] = delta['deadlocks']
+        row['temp_bytes_per_s'] = delta['temp_bytes'] / elapsed
+        if 'calls' in delta:
+            row['statements_per_s'] = float(delta['calls']) / elapsed
+            row['statement_mean_ms'] = float(delta['statement_time']) / delta['calls'] if delta['calls'] else None
+        else:
+            row['statements_per_s'] = row['statement_mean_ms'] = None
+        with open('/proc/loadavg') as f:
+            row['load1'] = float(f.read().split()[0])
+        cpu_total = delta['cpu_total']
+        row['cpu_busy_pct'] = 100.0 * (cpu_total - delta['cpu_idle']) / cpu_total if cpu_total else None
+        row['context_switches_per_s'] = delta['ctxt'] / elapsed
+        self.last_time = now
+        self.last_counters = counters
+        return row
+
+    def close(self):
+        self.conn.close()
+
+
+def _fmt_ms(value):
+    return '%8s' % '-' if value is None else '%8.3f' % value
+
+
+def _fmt(value, format='%d'):
+    return '-' if value is None else format % value
+
+
+class UniformParam(object):
+    def __init__(self, spec):
+        self.low = int(spec.get('min', 1))
+        self.high = int(spec['max'])
+
+    def __call__(self, session):
+        return random.randint(self.low, self.high)
+
+
+class SequentialParam(object):
+    """start + stride * connection number + step * number of queries this connection has sent"""
+
+    def __init__(self, spec):
+        self.start = int(spec.get('start', 0))
+        self.step = int(spec.get('step', 1))
+        self.stride = int(spec.get('stride', 0))
+
+    def __call__(self, session):
+        return self.start + self.stride * session.connection_number + self.step * session.i
+
+
+class ZipfianParam(object):
+    """Zipf-distributed ids in [min, max], with min the hottest unless scramble is set
+
+    This is the generator from Gray et al., "Quickly Generating Billion-Record Synthetic
+    Databases" (as used by YCSB), which only needs theta < 1. Building one is O(max - min),
+    so do it before forking.
+    """
+
+    def __init__(self, spec):
+        self.low = int(spec.get('min', 1))
+        self.n = int(spec['max']) - self.low + 1
+        self.theta = float(spec.get('theta', 0.99))
+        self.scramble = bool(spec.get('scramble', False))
+        if not 0 < self.theta < 1:
+            raise ValueError('zipfian theta must be in (0, 1)')
+        self.zetan = sum(1.0 / (i ** self.theta) for i in range(1, self.n + 1))
+        zeta2 = 1 + 0.5 ** self.theta
+        self.alpha = 1.0 / (1 - self.theta)
+        self.eta = (1 - (2.0 / self.n) ** (1 - self.theta)) / (1 - zeta2 / self.zetan)
+        self.half_pow_theta = 0.5 ** self.theta
+
+    def __call__(self, session):
+        u = random.random()
+        uz = u * self.zetan
+        if uz < 1:
+            rank = 0
+        elif uz < 1 + self.half_pow_theta:
+            rank = 1
+        else:
+            rank = min(int(self.n * ((self.eta * u - self.eta + 1) ** self.alpha)), self.n - 1)
+        if self.scramble:
+            # spread the hot keys out across the range instead of bunching them at min
+            rank = _fnv1a_64(rank) % self.n
+        return self.low + rank
+
+
+class ChoiceParam(object):
+    def __init__(self, spec):
+        self.values = list(spec['values'])
+
+    def __call__(self, session):
+        return random.choice(self.values)
+
+
+def _fnv1a_64(value):
+    h = 0xcbf29ce484222325
+    for _ in range(8):
+        h = ((h ^ (value & 0xff)) * 0x100000001b3) & 0xffffffffffffffff
+        value >>= 8
+    return h
+
+
+PARAM_TYPES = {
+    'uniform': UniformParam,
+    'sequential': SequentialParam,
+    'zipfian': ZipfianParam,
+    'choice': ChoiceParam,
+}
+
+Query = collections.namedtuple('Query', ['name', 'sql', 'weight', 'params'])
+Transaction = collections.namedtuple('Transaction', ['weight', 'steps', 'end'])
+
+
+class Workload(object):
+    """A weighted mix of queries and the transactions they're grouped into
+
+    A workload file is JSON like:
+
+        {
+          "queries": [
+            {"name": "tag", "sql": "SELECT id, name FROM user_tags WHERE id=%s", "weight": 3,
+             "params": [{"type": "zipfian", "min": 1, "max": 100000, "scramble": true}]},
+            {"name": "user", "sql": "SELECT email FROM users WHERE usersid=%s",
+             "params": [{"type": "uniform", "min": 1, "max": 100000}]}
+          ],
+          "transactions": [
+            {"weight": 9, "steps": ["*"], "end": "commit"},
+            {"weight": 1, "steps": ["user", "tag", "tag"], "end": "rollback"}
+          ]
+        }
+
+    Each query's params are generated by uniform (min, max), sequential (start, step,
+    stride), zipfian (min, max, theta, scramble) or choice (values). A transaction step
+    names a query, or is "*" to pick one from the mix, which is by weight or, with
+    "mix": "round_robin", in turn. Transactions end with commit, rollback or none
+    (autocommit).
+    """
+
+    ENDS = ('commit', 'rollback', 'none')
+
+    def __init__(self, spec):
+        self.mix = spec.get('mix', 'weighted')
+        if self.mix not in ('weighted', 'round_robin'):
+            raise ValueError('mix must be weighted or round_robin')
+        self.queries = []
+        for query in spec['queries']:
+            params = []
+            for param in query.get('params', []):
+                if param.get('type') not in PARAM_TYPES:
+                    raise ValueError('unknown param type %r' % param.get('type'))
+                params.append(PARAM_TYPES[param['type']](param))
+            self.queries.append(
+                Query(query.get('name', query['sql']), query['sql'], float(query.get('weight', 1)), params)
+            )
+        if not self.queries:
+            raise ValueError('a workload needs at least one query')
+        by_name = dict((query.name, query_number) for query_number, query in enumerate(self.queries))
+        if len(by_name) != len(self.queries):
+            raise ValueError('query names must be unique')
+        self.transactions = []
+        for transaction in spec.get('transactions', [{'steps': ['*'], 'end': 'commit'}]):
+            steps = []
+            for step in transaction['steps']:
+                if step != '*' and step not in by_name:
+                    raise ValueError('transaction step %r is not a query' % step)
+                steps.append(None if step == '*' else by_name[step])
+            end = transaction.get('end', 'commit')
+            if end not in self.ENDS:
+                raise ValueError('transaction end must be one of %s' % ', '.join(self.ENDS))
+            self.transactions.append(Transaction(float(transaction.get('weight', 1)), steps, end))
+        self.query_cdf = _cumulative(query.weight for query in self.queries)
+        self.transaction_cdf = _cumulative(transaction.weight for transaction in self.transactions)
+        self.prepare_sql = [
+            'PREPARE pg_stress_%d AS %s' % (query_number, _numbered_placeholders(query.sql))
+            for query_number, query in enumerate(self.queries)
+        ]
+        self.execute_sql = [
+            'EXECUTE pg_stress_%d' % query_number
+            + ('(%s)' % ', '.join(['%s'] * len(query.params)) if query.params else '')
+            for query_number, query in enumerate(self.queries)
+        ]
+        self.layout = Layout(len(self.queries))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def session(self, connection_number):
+        return Session(self, connection_number)
+
+
+def _numbered_placeholders(sql):
+    """Turn psycopg2's %s placeholders into the $1, $2, ... that PREPARE wants"""
+    counter = itertools.count(1)
+    return re.sub(r'%([%s])', lambda m: '%' if m.group(1) == '%' else '$%d' % next(counter), sql)
+
+
+def _cumulative(weights):
+    rv = []
+    total = 0
+    for weight in weights:
+        total += weight
+        rv.append(total)
+    return rv
+
+
+class Session(object):
+    """One connection's walk through a workload"""
+
+    def __init__(self, workload, connection_number):
+        self.workload = workload
+        self.connection_number = connection_number
+        self.i = 0
+
+    def _pick(self, cdf):
+        return bisect.bisect_right(cdf, random.random() * cdf[-1])
+
+    def next_transaction(self):
+        """Return (end, steps) for the next transaction; steps is a list of query numbers"""
+        workload = self.workload
+        transaction = workload.transactions[self._pick(workload.transaction_cdf)]
+        return transaction.end, transaction.steps
+
+    def next_query(self, query_number=None):
+        """Return (query number, sql, params), picking a query from the mix if one isn't given"""
+        self.i += 1
+        workload = self.workload
+        if query_number is None:
+            if workload.mix == 'round_robin':
+                query_number = self.i % len(workload.queries)
+            else:
+                query_number = self._pick(workload.query_cdf)
+        query = workload.queries[query_number]
+        return query_number, query.sql, tuple(param(self) for param in query.params)
+
+
+class Schedule(object):
+    """When one child should send each query in open-loop mode"""
+
+    def __init__(self, rate, arrival, start):
+        self.rate = rate
+        self.arrival = arrival
+        # start each child at a random phase so they don't all fire together
+        self.next_time = start + random.random() / rate if arrival == 'constant' else start + self._gap()
+
+    def _gap(self):
+        if self.arrival == 'poisson':
+            return random.expovariate(self.rate)
+        return 1.0 / self.rate
+
+    def advance(self):
+        scheduled = self.next_time
+        self.next_time += self._gap()
+        return scheduled
+
+    def next_send(self, recorder, max_lag):
+        """Return when the next query is due, skipping (and counting) any which are hopelessly overdue"""
+        while True:
+            scheduled = self.advance()
+            if not max_lag or time.time() - scheduled <= max_lag:
+                return scheduled
+            recorder.count('missed')
+
+
+def batch_statement(cur, workload, mode, queries):
+    """Return (sql, params) which run a list of (query number, sql, params) in one round trip"""
+    if len(queries) > 1:
+        return '; '.join(cur.mogrify(sql, params) for _, sql, params in queries), None
+    (query_number, sql, params), = queries
+    if mode == 'prepared':
+        return workload.execute_sql[query_number], params
+    return sql, params
+
+
+def result_rows(cur):
+    """Rows returned by a query, or affected by a statement which doesn't return any"""
+    if cur.description is None:
+        return max(cur.rowcount, 0)
+    return len(cur.fetchall())
+
+
+def record_batch(recorder, batch, rows):
+    """Record a finished batch of ((query number, sql, params), start); only the last query's rows are visible"""
+    now = time.time()
+    for i, ((query_number, _, _), start) in enumerate(batch):
+        recorder.record(query_number, now - start, rows if i == len(batch) - 1 else 0)
+
+
+def run_batch(conn, recorder, workload, mode, batch):
+    """Run a batch of ((query number, sql, params), start), recording latencies measured from each start"""
+    cur = conn.cursor()
+    try:
+        cur.execute(*batch_statement(cur, workload, mode, [query for query, _ in batch]))
+        rows = result_rows(cur)
+    except psycopg2.Error:
+        recorder.count('errors')
+        raise
+    record_batch(recorder, batch, rows)
+
+
+def connect(args, workload, recorder, prepare):
+    """Open a connection, timing how long it takes, and PREPARE the workload's queries if asked"""
+    start = time.time()
+    try:
+        conn = psycopg2.connect(args.dsn)
+    except psycopg2.Error:
+        recorder.count('connect_errors')
+        raise
+    recorder.record_connect(time.time() - start)
+    if prepare:
+        # prepared statements outlive transactions, so this only needs doing once
+        cur = conn.cursor()
+        for sql in workload.prepare_sql:
+            cur.execute(sql)
+        conn.commit()
+    return conn
+
+
+def reconnect_due(args, connected_at, transactions):
+    """Whether it's time to drop a connection and make a new one, to simulate churn"""
+    if args.transactions_per_connection and transactions >= args.transactions_per_connection:
+        return True
+    if args.connection_lifetime and time.time() - connected_at >= args.connection_lifetime / 1000.0:
+        return True
+    return False
+
+
+def runner(child_number, shm, args, workload, idle, rate):
+    random.seed(None if args.seed is None else (args.seed, child_number))
+    my_random_sleep = random.random() * args.sleep_time / 1000.0
+    layout = workload.layout
 
     # initialize the shm segment
-    shm.seek(child_number * PER_PROCESS_SHM_SIZE)
+    shm.seek(layout.result_offset(child_number))
     shm.write(struct.pack('@i', 0))
+    recorder = Recorder(shm, layout, child_number)
 
     # connect and run test
     start = time.time()
     results = collections.Counter()
     conn = None
-    times = []
     target_time = time.time() + (args.run_time - 2)
+    session = workload.session(child_number)
+    if rate:
+        # Open loop: queries go out on a fixed schedule no matter how long the
+        # previous ones took, and latency is measured from when the query should
+        # have been sent, so a slow server shows up as latency instead of as less
+        # load (coordinated omission).
+        schedule = Schedule(rate, args.arrival, time.time())
+        late_threshold = args.late_threshold / 1000.0
+        max_lag = args.max_lag / 1000.0
+
+    def wait_to_send():
+        """Return the time the next query is being sent as of, or None if we're done"""
+        if not rate:
+            now = time.time()
+            return now if now < target_time else None
+        scheduled = schedule.next_send(recorder, max_lag)
+        if scheduled >= target_time:
+            return None
+        lag = time.time() - scheduled
+        if lag < 0:
+            time.sleep(-lag)
+        elif lag > late_threshold:
+            recorder.count('late')
+        return scheduled
+
     try:
-        conn = psycopg2.connect("host=/var/run/postgresql dbname=%s" % args.dbname)
+        prepare = args.mode == 'prepared' and not idle
+        conn = connect(args, workload, recorder, prepare)
+        connected_at = time.time()
+        transactions = 0
         if idle:
             time.sleep(target_time - time.time())
         else:
-            i = 0
-            while time.time() < target_time:
-                i += 1
-                results['attempted'] += 1
-                cur = conn.cursor()
-                row_id = (child_number * 2000) + i
-                start_inner = time.time()
-                cur.execute(*gen_query(row_id))
-                for row in cur:
-                    results['good'] += 1
-                times.append(time.time() - start_inner)
-                time.sleep(my_random_sleep)
-                if i % 4 == 0:
+            finished = False
+            while not finished:
+                if reconnect_due(args, connected_at, transactions):
+                    conn.close()
+                    conn = connect(args, workload, recorder, prepare)
+                    connected_at = time.time()
+                    transactions = 0
+                transactions += 1
+                end, steps = session.next_transaction()
+                conn.autocommit = (end == 'none')
+                batch_size = len(steps) if args.mode == 'batched' else 1
+                for i in range(0, len(steps), batch_size):
+                    batch = []
+                    for step in steps[i:i + batch_size]:
+                        sent = wait_to_send()
+                        if sent is None:
+                            finished = True
+                            break
+                        batch.append((session.next_query(step), sent))
+                    if batch:
+                        run_batch(conn, recorder, workload, args.mode, batch)
+                    if finished:
+                        break
+                    if not rate:
+                        time.sleep(my_random_sleep)
+                if end == 'commit':
+                    conn.commit()
+                elif end == 'rollback':
                     conn.rollback()
         conn.close()
     except Exception:
@@ -71,33 +859,306 @@ def runner(child_number, shm, args):
     results = dict(results)
     if idle:
         results['idle_threads'] = 1
-    else:
-        results['avg_query_ms'] = 1000 * sum(times) / float(len(times))
     results['run_time'] = end - start
 
     # write out to the shm segment and go away
     encres = json.dumps(results).encode('utf-8')
-    assert len(encres) < PER_PROCESS_SHM_SIZE
-    shm.seek(child_number * PER_PROCESS_SHM_SIZE)
+    assert len(encres) + 4 <= RESULT_SIZE
+    shm.seek(layout.result_offset(child_number))
+    shm.write(struct.pack('@i', len(encres)))
+    shm.write(encres)
+    os._exit(0)
+
+
+class AsyncClient(object):
+    """One non-blocking connection driven by an async_runner's poll loop"""
+
+    def __init__(self, connection_number, args, workload, recorder, idle, rate, target_time):
+        self.args = args
+        self.workload = workload
+        self.recorder = recorder
+        self.idle = idle
+        self.target_time = target_time
+        self.session = workload.session(connection_number)
+        self.sleep_time = random.random() * args.sleep_time / 1000.0
+        self.schedule = Schedule(rate, args.arrival, time.time()) if rate and not idle else None
+        self.steps = []
+        self.end = None
+        self.in_transaction = False
+        # PREPAREs, BEGINs, COMMITs and ROLLBACKs to send before the next query
+        self.controls = collections.deque(workload.prepare_sql if args.mode == 'prepared' else [])
+        self.cursor = None
+        # ((query number, sql, params), start) for each query in flight
+        self.batch = None
+        self.batch_starts = None
+        self.done = False
+        self.connect_failed = False
+        self.connect()
+
+    def connect(self):
+        self.connect_started = time.time()
+        self.connecting = True
+        self.transactions = 0
+        try:
+            self.conn = psycopg2.connect(self.args.dsn, async_=1)
+        except psycopg2.Error:
+            self.recorder.count('connect_errors')
+            self.connect_failed = True
+            raise
+        self.fd = self.conn.fileno()
+
+    def reconnect_due(self):
+        if self.idle or self.connecting or self.in_transaction or self.steps or self.controls:
+            return False
+        return reconnect_due(self.args, self.connect_started, self.transactions)
+
+    def reconnect(self):
+        self.conn.close()
+        if self.args.mode == 'prepared':
+            self.controls.extend(self.workload.prepare_sql)
+        self.connect()
+
+    def poll(self):
+        """Advance whatever is in flight; returns the poll events to wait for, or None if nothing is"""
+        try:
+            state = self.conn.poll()
+        except psycopg2.Error:
+            if self.connecting:
+                self.recorder.count('connect_errors')
+                self.connect_failed = True
+            raise
+        if state == psycopg2.extensions.POLL_READ:
+            return select.POLLIN
+        elif state == psycopg2.extensions.POLL_WRITE:
+            return select.POLLOUT
+        if self.connecting:
+            self.recorder.record_connect(time.time() - self.connect_started)
+            self.connecting = False
+        if self.cursor is not None:
+            if self.batch is not None:
+                record_batch(self.recorder, self.batch, result_rows(self.cursor))
+                self.batch = None
+            self.cursor = None
+        return None
+
+    def next_send(self):
+        """Return when this client next wants to send something, or None if it's finished
+
+        Async connections are always in autocommit mode, so transactions are done with
+        explicit BEGIN and COMMIT/ROLLBACK statements, which go out right away and
+        aren't timed.
+        """
+        if self.idle:
+            return None
+        if self.controls:
+            return time.time()
+        if self.in_transaction and not self.steps:
+            self.controls.append(self.end.upper())
+            self.in_transaction = False
+            return time.time()
+        if not self.steps:
+            self.transactions += 1
+            self.end, steps = self.session.next_transaction()
+            self.steps = list(steps)
+            if self.end != 'none':
+                self.controls.append('BEGIN')
+                self.in_transaction = True
+                return time.time()
+        batch_size = len(self.steps) if self.args.mode == 'batched' else 1
+        if self.schedule is not None:
+            # a batch goes out once the last query in it is due
+            self.batch_starts = [
+                self.schedule.next_send(self.recorder, self.args.max_lag / 1000.0)
+                for _ in range(batch_size)
+            ]
+            scheduled = self.batch_starts[-1]
+        else:
+            self.batch_starts = None
+            scheduled = time.time() + (self.sleep_time if self.session.i else 0)
+        if scheduled >= self.target_time:
+            return None
+        return scheduled
+
+    def send(self, scheduled):
+        self.cursor = self.conn.cursor()
+        if self.controls:
+            self.cursor.execute(self.controls.popleft())
+            return
+        if self.batch_starts is not None:
+            starts = self.batch_starts
+            late_threshold = self.args.late_threshold / 1000.0
+            for start in starts:
+                if time.time() - start > late_threshold:
+                    self.recorder.count('late')
+        else:
+            starts = [time.time()] * (len(self.steps) if self.args.mode == 'batched' else 1)
+        queries = [self.session.next_query(self.steps.pop(0)) for _ in starts]
+        self.batch = zip(queries, starts)
+        self.cursor.execute(*batch_statement(self.cursor, self.workload, self.args.mode, queries))
+
+    def close(self):
+        self.done = True
+        self.conn.close()
+
+
+def async_runner(worker_number, shm, args, workload, connections, rate):
+    """Drive a bunch of connections from one process; connections is a list of (connection_number, idle)"""
+    random.seed(None if args.seed is None else (args.seed, worker_number))
+    layout = workload.layout
+
+    shm.seek(layout.result_offset(worker_number))
+    shm.write(struct.pack('@i', 0))
+    recorder = Recorder(shm, layout, worker_number)
+
+    # thousands of connections need thousands of fds
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    start = time.time()
+    results = collections.Counter()
+    target_time = time.time() + (args.run_time - 2)
+    poller = select.poll()
+    by_fd = {}
+    # (when, connection_number, client) for clients waiting to send their next query
+    timers = []
+
+    def fail(client):
+        # connect failures were already counted by the client
+        if not client.connect_failed:
+            recorder.count('errors')
+        results['exception'] += 1
+        if client.fd in by_fd:
+            poller.unregister(client.fd)
+            del by_fd[client.fd]
+        client.close()
+
+    def step(client):
+        try:
+            events = client.poll()
+        except psycopg2.Error:
+            fail(client)
+            return
+        if events is not None:
+            if client.fd not in by_fd:
+                by_fd[client.fd] = client
+                poller.register(client.fd, events)
+            else:
+                poller.modify(client.fd, events)
+            return
+        if client.fd in by_fd:
+            poller.unregister(client.fd)
+            del by_fd[client.fd]
+        if client.reconnect_due():
+            try:
+                client.reconnect()
+            except psycopg2.Error:
+                fail(client)
+                return
+            step(client)
+            return
+        scheduled = client.next_send()
+        if scheduled is not None:
+            heapq.heappush(timers, (scheduled, client.session.connection_number, client))
+
+    clients = []
+    for connection_number, idle in connections:
+        try:
+            client = AsyncClient(connection_number, args, workload, recorder, idle, rate, target_time)
+        except psycopg2.Error:
+            results['exception'] += 1
+            continue
+        clients.append(client)
+        step(client)
+
+    while time.time() < target_time and (by_fd or timers):
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            scheduled, _, client = heapq.heappop(timers)
+            try:
+                client.send(scheduled)
+            except psycopg2.Error:
+                fail(client)
+                continue
+            step(client)
+        timeout = target_time - now
+        if timers:
+            timeout = min(timeout, timers[0][0] - now)
+        for fd, _ in poller.poll(max(0, timeout) * 1000):
+            step(by_fd[fd])
+    if not by_fd and not timers:
+        # only idle connections left
+        time.sleep(max(0, target_time - time.time()))
+
+    for client in clients:
+        if not client.done:
+            client.close()
+    end = time.time()
+    results = dict(results)
+    results['connections'] = len(connections)
+    results['idle_threads'] = sum(1 for _, idle in connections if idle)
+    results['run_time'] = end - start
+
+    encres = json.dumps(results).encode('utf-8')
+    assert len(encres) + 4 <= RESULT_SIZE
+    shm.seek(layout.result_offset(worker_number))
     shm.write(struct.pack('@i', len(encres)))
     shm.write(encres)
     os._exit(0)
 
 
+def print_latencies(workload, histograms, overall, connect):
+    columns = ['count', 'mean'] + ['p%s' % pct for pct in PERCENTILES] + ['max']
+    print('%-50s %10s' % ('latency (ms)', 'count') + ''.join('%10s' % c for c in columns[1:]))
+    names = [query.name for query in workload.queries]
+    for name, histogram in zip(names, histograms) + [('all', overall), ('(connect)', connect)]:
+        summary = histogram.summary_ms()
+        print('%-50s %10d' % (name[:50], summary['count']) + ''.join(
+            '%10.3f' % summary[c] if c in summary else '%10s' % '-' for c in columns[1:]
+        ))
+
+
+def print_comparison(args, runs):
+    """Print throughput and latency for each of a list of (mode, results, overall histogram), relative to the first"""
+    window = float(max(args.run_time - 2, 1))
+    columns = [('qps', lambda d, h: d.get('attempted', 0) / window)]
+    columns.append(('mean', lambda d, h: h.mean() / 1000.0 if h.total else None))
+    for pct in PERCENTILES:
+        columns.append(('p%s' % pct, lambda d, h, pct=pct: h.percentile(pct) / 1000.0 if h.total else None))
+    print('%-10s' % 'mode' + ''.join('%12s %8s' % (name, 'delta') for name, _ in columns))
+    baseline = None
+    for mode, d, overall in runs:
+        values = [f(d, overall) for _, f in columns]
+        if baseline is None:
+            baseline = values
+        line = '%-10s' % mode
+        for value, base in zip(values, baseline):
+            if value is None:
+                line += '%12s %8s' % ('-', '-')
+            elif not base:
+                line += '%12.3f %8s' % (value, '-')
+            else:
+                line += '%12.3f %+7.1f%%' % (value, 100.0 * (value - base) / base)
+        print(line)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-d',
         '--dbname',
-        required=True,
-        help='Name of the postgres database to connect to'
+        help='Name of the postgres database to connect to over the local unix socket'
+    )
+    parser.add_argument(
+        '--dsn',
+        help='libpq connection string to use instead of --dbname, e.g. to go over TCP or through a pooler'
     )
     parser.add_argument(
         '-c',
         '--children',
         type=int,
         default=16,
-        help='Number of children to spawn (default %(default)s)'
+        help='Number of children to spawn, or with --engine async, connections to open (default %(default)s)'
     )
     parser.add_argument(
         '-r',
@@ -120,39 +1181,207 @@ def main():
         default=20,
         help='Number of ms for children to sleep between queries (default %(default)s)'
     )
+    parser.add_argument(
+        '--workload',
+        default=None,
+        help='JSON file describing the queries to run and how (default alternates between two lookups by id)'
+    )
+    parser.add_argument(
+        '--mode',
+        choices=MODES,
+        default='simple',
+        help=('How queries are sent: as-is, as prepared statements, or a whole transaction\'s '
+              'worth at a time (default %(default)s)')
+    )
+    parser.add_argument(
+        '--compare-modes',
+        action='store_true',
+        help='Run the benchmark once in each --mode and compare throughput and latency'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Seed the random choices (idle children, sleeps, params) to make runs repeatable'
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=0,
+        help=('Run open-loop at this many queries/sec in total, split across the non-idle children, '
+              'instead of sleeping between queries; 0 for closed-loop (default %(default)s)')
+    )
+    parser.add_argument(
+        '--arrival',
+        choices=('constant', 'poisson'),
+        default='poisson',
+        help='How queries are spaced out in --rate mode (default %(default)s)'
+    )
+    parser.add_argument(
+        '--late-threshold',
+        type=float,
+        default=1,
+        help='In --rate mode, count a query as late if it went out this many ms after it was due (default %(default)s)'
+    )
+    parser.add_argument(
+        '--max-lag',
+        type=float,
+        default=1000,
+        help=('In --rate mode, skip (and count as missed) queries which are this many ms overdue '
+              'rather than trying to catch up; 0 to never skip (default %(default)s)')
+    )
+    parser.add_argument(
+        '--transactions-per-connection',
+        type=int,
+        default=0,
+        help='Reconnect after this many transactions; 0 to keep connections for the whole run (default %(default)s)'
+    )
+    parser.add_argument(
+        '--connection-lifetime',
+        type=float,
+        default=0,
+        help='Reconnect (between transactions) once a connection is this many ms old; 0 for never (default %(default)s)'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=('fork', 'async'),
+        default='fork',
+        help=('fork runs one process per connection; async multiplexes the connections over '
+              '--processes worker processes with non-blocking I/O (default %(default)s)')
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=os.sysconf('SC_NPROCESSORS_ONLN'),
+        help='Number of worker processes for --engine async (default %(default)s)'
+    )
+    parser.add_argument(
+        '--report-interval',
+        type=int,
+        default=1000,
+        help='Print throughput and latency every this many ms; 0 to disable (default %(default)s)'
+    )
+    parser.add_argument(
+        '--sample-server',
+        action='store_true',
+        help=('Every --report-interval, also sample pg_stat_activity, pg_stat_database, pg_stat_statements '
+              'and this host\'s load and context switches on a separate connection')
+    )
+    parser.add_argument(
+        '--sampler-dsn',
+        help='Connection string for --sample-server, if --dsn goes through a pooler (default: --dsn)'
+    )
+    parser.add_argument(
+        '--timeseries-file',
+        default=None,
+        help='Also write each interval to this file'
+    )
+    parser.add_argument(
+        '--timeseries-format',
+        choices=('csv', 'json'),
+        default='csv',
+        help='Format for --timeseries-file (default %(default)s)'
+    )
     args = parser.parse_args()
-    shm = mmap.mmap(-1, (args.children + 1) * PER_PROCESS_SHM_SIZE)
+    if args.sample_server and args.report_interval <= 0:
+        parser.error('--sample-server needs a --report-interval')
+    if args.dsn is None:
+        if args.dbname is None:
+            parser.error('one of --dbname or --dsn is required')
+        args.dsn = "host=/var/run/postgresql dbname=%s" % args.dbname
+    try:
+        workload = Workload.load(args.workload) if args.workload else Workload(DEFAULT_WORKLOAD)
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        parser.error('bad workload: %s' % e)
+    timeseries = open(args.timeseries_file, 'w') if args.timeseries_file else None
+    if not args.compare_modes:
+        d, histograms, overall, connect = run(args, workload, timeseries)
+        print(d)
+        print_latencies(workload, histograms, overall, connect)
+        return
+    # every mode gets the same idle children, sleeps and params
+    if args.seed is None:
+        args.seed = random.randrange(1 << 32)
+    runs = []
+    for mode in MODES:
+        print('=== %s ===' % mode)
+        args.mode = mode
+        d, histograms, overall, connect = run(args, workload, timeseries)
+        print(d)
+        print_latencies(workload, histograms, overall, connect)
+        runs.append((mode, d, overall))
+    print_comparison(args, runs)
+
+
+def run(args, workload, timeseries):
+    """Run the benchmark once; returns (results, per-query histograms, overall histogram, connect histogram)"""
+    layout = workload.layout
+    if args.engine == 'async':
+        processes = min(args.processes, args.children)
+    else:
+        processes = args.children
+    shm = mmap.mmap(-1, (processes + 1) * layout.slot_size)
 
     children = {}
     live_children = set()
 
+    # pick the idle children up front so --rate can be split across the rest
+    rng = random.Random(args.seed)
+    idle_children = set(
+        child_number for child_number in range(1, args.children + 1)
+        if rng.random() < args.idle_fraction
+    )
+    active_children = args.children - len(idle_children)
+    rate = args.rate / active_children if active_children and args.rate else 0
+
     # spawn our children
-    for child_number in range(1, args.children + 1):
+    for child_number in range(1, processes + 1):
         pid = os.fork()
         if pid == 0:
-            runner(child_number, shm, args)
+            if args.engine == 'async':
+                connections = [
+                    (connection_number, connection_number in idle_children)
+                    for connection_number in range(child_number, args.children + 1, processes)
+                ]
+                async_runner(child_number, shm, args, workload, connections, rate)
+            else:
+                runner(child_number, shm, args, workload, child_number in idle_children, rate)
             os._exit(0)
         else:
             children[pid] = child_number
             live_children.add(pid)
 
     start_runs = time.time()
+    reporter = None
+    if args.report_interval > 0:
+        # connect after forking so the children don't inherit the connection
+        sampler = ServerSampler(args.sampler_dsn or args.dsn) if args.sample_server else None
+        reporter = Reporter(start_runs, args.mode, timeseries, args.timeseries_format, sampler)
+        next_report = start_runs + args.report_interval / 1000.0
     # let the tests run
     d = {'children': 0}
     while time.time() - start_runs < args.run_time:
         if not live_children:
             break
+        if reporter is not None and time.time() >= next_report:
+            reporter.sample(*snapshot(shm, layout, children.values()))
+            next_report += args.report_interval / 1000.0
         pid, _ = os.waitpid(-1, os.WNOHANG)
         if pid == 0:
-            time.sleep(0.1)
+            time.sleep(0.1 if reporter is None else max(0, min(0.1, next_report - time.time())))
             continue
         else:
             live_children.remove(pid)
             d['children'] += 1
             child_number = children[pid]
             # read back the output
-            shm.seek(child_number * PER_PROCESS_SHM_SIZE)
+            shm.seek(layout.result_offset(child_number))
             bytes_output = struct.unpack('@i', shm.read(4))[0]
+            if not bytes_output:
+                # the child died before it got to write anything out
+                d.setdefault('exception', 0)
+                d['exception'] += 1
+                continue
             output = json.loads(shm.read(bytes_output))
             for key, value in output.iteritems():
                 if isinstance(value, int):
@@ -163,7 +1392,7 @@ def main():
                     d[key] += (1 if value else 0)
                 else:
                     d.setdefault(key, 0)
-                    d[key] += (value / args.children)
+                    d[key] += (value / processes)
     else:
         print("timeout")
         for pid in live_children:
@@ -173,12 +1402,29 @@ def main():
                 gotpid, _ = os.waitpid(pid, os.WNOHANG)
                 if gotpid == 0:
                     os.kill(pid, 9)
-                    os.waitpid(pid)
+                    os.waitpid(pid, 0)
             except Exception as e:
                 print(e)
                 continue
 
-    print(d)
+    # the live sections survive children which were killed, so count everybody
+    counters, histograms, connect = snapshot(shm, layout, children.values())
+    if reporter is not None:
+        reporter.sample(counters, histograms, connect)
+        if reporter.sampler is not None:
+            reporter.sampler.close()
+    d.update(counters)
+    if args.rate:
+        d['target_qps'] = args.rate
+        d['achieved_qps'] = counters['attempted'] / float(max(args.run_time - 2, 1))
+    overall = Histogram()
+    for histogram in histograms:
+        overall.merge(histogram)
+    if overall.total:
+        d['avg_query_ms'] = overall.mean() / 1000.0
+    if connect.total:
+        d['avg_connect_ms'] = connect.mean() / 1000.0
+    return d, histograms, overall, connect
 
 
 if __name__ == '__main__':
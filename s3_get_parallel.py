@@ -2,63 +2,1293 @@
 
 import argparse
 import boto
-import fnmatch
+import boto.exception
+import boto.s3.connection
+import boto.s3.prefix
+import collections
+import errno
 import functools
-import multiprocessing
+import hashlib
+import httplib
+import json
 import os
 import os.path
+import Queue
+import random
 import re
+import subprocess
 import tempfile
+import threading
+import time
 import sys
+import urlparse
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 S3_URI_REGEX = re.compile(r'^s3://(?P<bucket>[^/]+)/(?P<key>.+)')
+GLOB_MAGIC_REGEX = re.compile(r'[*?[]')
+SIZE_REGEX = re.compile(r'^(?P<number>\d+)(?P<suffix>[kKmMgGtT]?)[bB]?$')
+SIZE_SUFFIXES = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+RemoteKey = collections.namedtuple('RemoteKey', ['bucket_name', 'key_name', 'size', 'etag', 'last_modified'])
+# start and end are inclusive, just like an HTTP Range header
+Part = collections.namedtuple('Part', ['key', 'checkpoint', 'start', 'end'])
+# seq is the order in which the key was listed, for --ordered output
+StreamTask = collections.namedtuple('StreamTask', ['key', 'seq'])
+
+MAX_RETRIES = 5
+STAGING_DIR = '.s3_get_parallel'
+CHECKPOINT_INTERVAL = 16 << 20
+BASE_BACKOFF = 0.1
+MAX_BACKOFF = 20
+
+_thread_state = threading.local()
+_connect_kwargs = {}
+_STOP = object()
+
+
+def parse_size(value):
+    """Parse a human-friendly byte count like 512M or 2G"""
+    md = SIZE_REGEX.match(value.strip())
+    if not md:
+        raise argparse.ArgumentTypeError('Invalid size %r' % value)
+    return int(md.group('number')) * SIZE_SUFFIXES[md.group('suffix').lower()]
+
+
+def set_endpoint(url):
+    """Talk to an S3-compatible service at url (like http://localhost:9000) instead of AWS"""
+    global _connect_kwargs
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError('Invalid endpoint %r' % url)
+    _connect_kwargs = {
+        'host': parsed.hostname,
+        'is_secure': parsed.scheme == 'https',
+        # most S3 stand-ins don't do virtual-host style buckets
+        'calling_format': boto.s3.connection.OrdinaryCallingFormat(),
+    }
+    if parsed.port:
+        _connect_kwargs['port'] = parsed.port
+
+
+def get_bucket(bucket_name):
+    """Return a handle to bucket_name on this thread's persistent S3 connection.
+
+    boto connections aren't safe to share between threads, but each one keeps its
+    HTTP connections alive between requests, so every thread gets exactly one. Handles
+    are created without validation; the first real request will fail if the bucket
+    doesn't exist."""
+    buckets = getattr(_thread_state, 'buckets', None)
+    if buckets is None or _thread_state.connect_kwargs is not _connect_kwargs:
+        _thread_state.conn = boto.connect_s3(**_connect_kwargs)
+        _thread_state.connect_kwargs = _connect_kwargs
+        buckets = _thread_state.buckets = {}
+    if bucket_name not in buckets:
+        buckets[bucket_name] = _thread_state.conn.get_bucket(bucket_name, validate=False)
+    return buckets[bucket_name]
+
+
+def _glob_to_regex(pattern):
+    """Translate an S3 glob into a regex.
+
+    * and ? never match across a /, while ** matches any number of path levels
+    (including none). [...] and [!...] work like they do in fnmatch."""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        elif c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[%s]' % body)
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(out) + r'\Z', re.S)
+
+
+def _literal_head(segment):
+    md = GLOB_MAGIC_REGEX.search(segment)
+    return segment[:md.start()] if md else segment
+
 
+class Glob(object):
+    """One s3://bucket/pattern argument, split up for level-by-level listing"""
 
-def expand_globs(files_or_globs):
-    conn = boto.connect_s3()
-    buckets = {}
-    files = set()
+    def __init__(self, bucket_name, raw_key):
+        self.bucket_name = bucket_name
+        self.raw_key = raw_key
+        self.segments = raw_key.split('/')
+        self.regex = _glob_to_regex(raw_key)
+        self.segment_regexes = [_glob_to_regex(segment) for segment in self.segments]
+
+    @property
+    def is_literal(self):
+        return not GLOB_MAGIC_REGEX.search(self.raw_key)
+
+    def matches(self, key_name):
+        return self.regex.match(key_name) is not None
+
+    def advance(self, prefix, depth):
+        """Fold literal path segments into the prefix; there's no point listing them"""
+        while depth < len(self.segments) - 1 and not GLOB_MAGIC_REGEX.search(self.segments[depth]):
+            prefix += self.segments[depth] + '/'
+            depth += 1
+        return prefix, depth
+
+    def list_level(self, prefix, depth):
+        """List one level of the glob below prefix.
+
+        Yields matching boto Keys, and (prefix, depth) pairs for sub-prefixes which
+        still need to be listed."""
+        bucket = get_bucket(self.bucket_name)
+        segment = self.segments[depth]
+        list_prefix = prefix + _literal_head(segment)
+        if '**' in segment:
+            # no way to use the delimiter past a **, so just list everything under it
+            for key in bucket.list(prefix=list_prefix):
+                if self.matches(key.name):
+                    yield key
+        elif depth == len(self.segments) - 1:
+            for item in bucket.list(prefix=list_prefix, delimiter='/'):
+                if not isinstance(item, boto.s3.prefix.Prefix) and self.matches(item.name):
+                    yield item
+        else:
+            segment_regex = self.segment_regexes[depth]
+            for item in bucket.list(prefix=list_prefix, delimiter='/'):
+                if isinstance(item, boto.s3.prefix.Prefix):
+                    if segment_regex.match(item.name[len(prefix):-1]):
+                        yield self.advance(item.name, depth + 1)
+
+
+def _iter_keys(globs, list_parallelism):
+    """Expand globs by listing separate sub-prefixes on list_parallelism threads"""
+    jobs = Queue.Queue()
+    # bounded so that listing can't get too far ahead of downloading
+    results = Queue.Queue(maxsize=10000)
+    outstanding = [0]
+    lock = threading.Lock()
+
+    def add_job(job):
+        with lock:
+            outstanding[0] += 1
+        jobs.put(job)
+
+    def lister():
+        while True:
+            job = jobs.get()
+            if job is _STOP:
+                break
+            index, prefix, depth = job
+            glob = globs[index]
+            try:
+                if glob.is_literal:
+                    key = get_bucket(glob.bucket_name).get_key(glob.raw_key)
+                    if key is None:
+                        raise ValueError('No such key s3://%s/%s' % (glob.bucket_name, glob.raw_key))
+                    results.put((index, key, None))
+                else:
+                    for item in glob.list_level(prefix, depth):
+                        if isinstance(item, tuple):
+                            add_job((index, ) + item)
+                        else:
+                            results.put((index, item, None))
+            except Exception:
+                results.put((index, None, sys.exc_info()))
+            finally:
+                with lock:
+                    outstanding[0] -= 1
+                    if not outstanding[0]:
+                        results.put((None, _STOP, None))
+
+    for index, glob in enumerate(globs):
+        add_job((index, ) + glob.advance('', 0))
+    for _ in xrange(list_parallelism):
+        thread = threading.Thread(target=lister)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            index, key, exc_info = results.get()
+            if key is _STOP:
+                break
+            elif exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            glob = globs[index]
+            # A key matched by more than one glob is only yielded for the first of
+            # them. Checking the earlier globs costs a little CPU, but unlike a set of
+            # everything seen so far it doesn't grow with the size of the listing.
+            if not any(g.bucket_name == glob.bucket_name and g.matches(key.name) for g in globs[:index]):
+                yield RemoteKey(glob.bucket_name, key.name, key.size, key.etag, key.last_modified)
+    finally:
+        for _ in xrange(list_parallelism):
+            jobs.put(_STOP)
+
+
+def expand_globs(files_or_globs, list_parallelism=8):
+    """Return an iterator over the RemoteKeys matching files_or_globs.
+
+    Globs support *, ?, [...] and **. They're expanded a path level at a time using
+    delimiter listings, so only the prefixes that can actually match get listed, and
+    separate sub-prefixes are listed in parallel. URIs are validated up front, but
+    nothing is listed until the iterator is consumed, so downloads can start as soon as
+    the first page of a listing comes back. Keys are not yielded in any particular
+    order."""
+    globs = []
     for item in files_or_globs:
         parsed = S3_URI_REGEX.match(item)
         if not parsed:
             raise ValueError("Invalid URI %r" % item)
-        bucket_name = parsed.group('bucket')
-        raw_key = parsed.group('key')
-        if bucket_name not in buckets:
-            buckets[bucket_name] = conn.get_bucket(bucket_name)
-        bucket = buckets[bucket_name]
-        if raw_key.count('*') == 0:
-            files.add((bucket_name, bucket.get_key(raw_key).key.name))
+        globs.append(Glob(parsed.group('bucket'), parsed.group('key')))
+    return _iter_keys(globs, list_parallelism)
+
+
+def output_name_for(key, target_dir):
+    return os.path.join(target_dir, os.path.basename(key.key_name))
+
+
+class Manifest(object):
+    """What we last downloaded into a target dir, for --sync.
+
+    Stored as a single JSON object mapping s3://bucket/key to [etag, size,
+    last_modified]. Only the ETag and size are compared, since S3 formats
+    last-modified differently in listings and HEAD responses."""
+
+    FILENAME = '.s3_get_parallel.manifest'
+    SAVE_INTERVAL = 30
+
+    def __init__(self, target_dir):
+        self.path = os.path.join(target_dir, self.FILENAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.last_saved = time.time()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def _uri(key):
+        return 's3://%s/%s' % (key.bucket_name, key.key_name)
+
+    def is_current(self, key, output_name):
+        entry = self.entries.get(self._uri(key))
+        if entry is None or entry[:2] != [key.etag, key.size]:
+            return False
+        # don't trust the manifest if somebody has deleted or truncated the file since
+        return os.path.exists(output_name) and os.path.getsize(output_name) == key.size
+
+    def record(self, key):
+        with self.lock:
+            self.entries[self._uri(key)] = [key.etag, key.size, key.last_modified]
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=self.FILENAME + '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+            os.rename(tmp_name, self.path)
+            self.dirty = False
+            self.last_saved = time.time()
+
+    def maybe_save(self):
+        if time.time() - self.last_saved > self.SAVE_INTERVAL:
+            self.save()
+
+
+def _percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * pct / 100.0))]
+
+
+def _format_bytes(n):
+    for suffix in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return '%.1f %s' % (n, suffix)
+        n /= 1024.0
+    return '%.1f TiB' % n
+
+
+def _format_ms(seconds):
+    return '-' if seconds is None else '%dms' % (seconds * 1000)
+
+
+class Reservoir(object):
+    """A fixed-size uniform sample of a stream of values, for percentiles"""
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.samples = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
         else:
-            prefix = raw_key[:raw_key.index('*')]
-            for key in bucket.list(prefix=prefix):
-                if fnmatch.fnmatch(key.name, raw_key):
-                    files.add((bucket_name, key.name))
-    return list(sorted(files))
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self.samples[i] = value
 
+    def percentiles(self, *pcts):
+        samples = sorted(self.samples)
+        return dict(('p%s' % pct, _percentile(samples, pct)) for pct in pcts)
 
-def download_key(key, target_dir, allow_overwrite=False):
-    bucket_name, key_name = key
-    conn = boto.connect_s3()
-    output_name = os.path.join(target_dir, os.path.basename(key_name))
-    if os.path.exists(output_name) and not allow_overwrite:
-        return output_name, False
-    with tempfile.NamedTemporaryFile(delete=True) as fd:
-        bucket = conn.get_bucket(bucket_name)
-        bucket.get_key(key_name).get_contents_to_file(fd)
+
+class Request(object):
+    """Timing for a single GET; see Stats.request"""
+
+    def __init__(self, stats, name, expected_bytes):
+        self.stats = stats
+        self.name = name
+        self.expected_bytes = expected_bytes
+        self.worker = threading.current_thread().name
+        self.start = time.time()
+        self.first_byte = None
+        self.received = 0
+
+    def on_data(self, nbytes):
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.received += nbytes
+        self.stats.on_data(self, nbytes)
+
+    def __enter__(self):
+        self.stats.on_start(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stats.on_finish(self, exc_type is None)
+
+
+class MeteredFile(object):
+    """Wrap a file object so that writes into it are counted against a Request.
+
+    If a BandwidthLimit is given, writes block until it allows them, which in turn
+    stops boto reading from the socket and lets TCP slow the sender down."""
+
+    def __init__(self, fp, request, bandwidth_limit=None):
+        self._fp = fp
+        self._request = request
+        self._bandwidth_limit = bandwidth_limit
+
+    def write(self, data):
+        if self._bandwidth_limit is not None:
+            self._bandwidth_limit.consume(len(data))
+        self._request.on_data(len(data))
+        self._fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+class Stats(object):
+    """Throughput and latency for every request made by every worker thread"""
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.bytes = 0
+        self.objects = 0
+        self.failures = 0
+        self.retries = 0
+        self.skipped = 0
+        self.in_flight = set()
+        self.ttfb = Reservoir()
+        self.latency = Reservoir()
+        self.throttles = 0
+        self.workers = collections.defaultdict(collections.Counter)
+        self._last_sample = (self.start, 0)
+        # for the adaptive controller; see sample_window
+        self._window_start = (self.start, 0, 0)
+        self._window_ttfb = collections.deque(maxlen=1000)
+
+    def request(self, name, expected_bytes):
+        return Request(self, name, expected_bytes)
+
+    def on_start(self, request):
+        with self.lock:
+            self.in_flight.add(request)
+
+    def on_data(self, request, nbytes):
+        with self.lock:
+            self.bytes += nbytes
+            self.workers[request.worker]['bytes'] += nbytes
+
+    def on_finish(self, request, ok):
+        now = time.time()
+        with self.lock:
+            self.in_flight.discard(request)
+            worker = self.workers[request.worker]
+            worker['busy_seconds'] += now - request.start
+            if not ok:
+                self.failures += 1
+                worker['failures'] += 1
+                return
+            self.objects += 1
+            worker['requests'] += 1
+            if request.first_byte is not None:
+                self.ttfb.add(request.first_byte - request.start)
+                self._window_ttfb.append(request.first_byte - request.start)
+            self.latency.add(now - request.start)
+
+    def on_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+
+    def sample_window(self):
+        """Return (bytes/sec, median time to first byte, # of throttled requests) since the last call"""
+        now = time.time()
+        with self.lock:
+            start, start_bytes, start_throttles = self._window_start
+            self._window_start = (now, self.bytes, self.throttles)
+            ttfb = _percentile(sorted(self._window_ttfb), 50)
+            self._window_ttfb.clear()
+            return (
+                (self.bytes - start_bytes) / max(now - start, 1e-6),
+                ttfb,
+                self.throttles - start_throttles,
+            )
+
+    def on_skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def progress_line(self):
+        """One line of progress, including throughput since the previous call"""
+        now = time.time()
+        with self.lock:
+            last_time, last_bytes = self._last_sample
+            self._last_sample = (now, self.bytes)
+            rate = (self.bytes - last_bytes) / max(now - last_time, 1e-6)
+            pending = sum(max(r.expected_bytes - r.received, 0) for r in self.in_flight)
+            oldest = min(self.in_flight, key=lambda r: r.start) if self.in_flight else None
+            ttfb = self.ttfb.percentiles(50, 99)
+            line = ('[%ds] %d requests, %s, %s/s; %d in flight (%s to go); '
+                    'ttfb p50 %s p99 %s; %d retries, %d throttled') % (
+                now - self.start,
+                self.objects,
+                _format_bytes(self.bytes),
+                _format_bytes(rate),
+                len(self.in_flight),
+                _format_bytes(pending),
+                _format_ms(ttfb['p50']),
+                _format_ms(ttfb['p99']),
+                self.retries,
+                self.throttles,
+            )
+            if oldest is not None:
+                line += '; oldest %s on %s for %ds' % (oldest.name, oldest.worker, now - oldest.start)
+        return line
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        with self.lock:
+            return {
+                'elapsed_seconds': elapsed,
+                'requests': self.objects,
+                'failures': self.failures,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'skipped': self.skipped,
+                'bytes': self.bytes,
+                'bytes_per_second': self.bytes / max(elapsed, 1e-6),
+                'ttfb_seconds': self.ttfb.percentiles(*self.PERCENTILES),
+                'latency_seconds': self.latency.percentiles(*self.PERCENTILES),
+                'workers': dict(
+                    (name, dict(
+                        counter,
+                        bytes_per_second=counter['bytes'] / max(counter['busy_seconds'], 1e-6)
+                    ))
+                    for name, counter in self.workers.items()
+                ),
+            }
+
+
+class BandwidthLimit(object):
+    """A token bucket shared by every worker, refilled at bytes_per_second"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        # allow a quarter second of burst
+        self.capacity = self.rate / 4
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # go into debt rather than splitting writes up; the next caller pays it off
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConcurrencyLimit(object):
+    """A semaphore whose size can be changed while threads are waiting on it"""
+
+    def __init__(self, limit):
+        self.cond = threading.Condition()
+        self.limit = limit
+        self.active = 0
+        # most requests active at once since the last reset_peak
+        self.peak = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def reset_peak(self):
+        with self.cond:
+            peak, self.peak = self.peak, self.active
+            return peak
+
+
+class AdaptiveController(object):
+    """Adjust a ConcurrencyLimit based on what Stats has seen recently.
+
+    Additive increase while throughput keeps rising, multiplicative decrease when S3
+    throttles us or time to first byte climbs well above the best we've seen. Repeated
+    throttling halves the limit every interval, so backoff is exponential."""
+
+    GROWTH_THRESHOLD = 1.05
+    LATENCY_FACTOR = 3.0
+
+    def __init__(self, limit, stats, max_parallelism, interval=2.0):
+        self.limit = limit
+        self.stats = stats
+        self.max_parallelism = max_parallelism
+        self.interval = interval
+        self.last_throughput = 0
+        self.baseline_ttfb = None
+
+    def run(self, stopping):
+        self.stats.sample_window()
+        while not stopping.wait(self.interval):
+            self.adjust()
+
+    def adjust(self):
+        throughput, ttfb, throttles = self.stats.sample_window()
+        current = self.limit.limit
+        saturated = self.limit.reset_peak() >= current
+        if throttles:
+            new, reason = max(1, current // 2), '%d throttled requests' % throttles
+        elif ttfb is not None and self.baseline_ttfb is not None and ttfb > self.baseline_ttfb * self.LATENCY_FACTOR:
+            new, reason = max(1, current * 3 // 4), 'ttfb %s vs baseline %s' % (
+                _format_ms(ttfb), _format_ms(self.baseline_ttfb))
+        elif saturated and throughput > self.last_throughput * self.GROWTH_THRESHOLD:
+            new, reason = min(self.max_parallelism, current + max(1, current // 4)), 'throughput %s/s' % (
+                _format_bytes(throughput))
+        else:
+            new, reason = current, None
+        if ttfb is not None and not throttles:
+            self.baseline_ttfb = ttfb if self.baseline_ttfb is None else min(self.baseline_ttfb, ttfb)
+        self.last_throughput = throughput
+        if new != current:
+            print >>sys.stderr, 'concurrency %d -> %d (%s)' % (current, new, reason)
+            self.limit.set_limit(new)
+
+
+def report_progress(stats, interval, stopping):
+    while not stopping.wait(interval):
+        print >>sys.stderr, stats.progress_line()
+
+
+def _is_throttle(exc):
+    return exc.status == 503 or exc.error_code == 'SlowDown'
+
+
+def fetch(key, fp, stats=None, start=None, end=None, bandwidth_limit=None, max_retries=MAX_RETRIES, if_match=None):
+    """GET a RemoteKey (or bytes start-end of it) and write it to fp.
+
+    Server errors, including throttling (503 SlowDown), are retried here with
+    exponential backoff and jitter, rewriting fp from where it started. boto's own
+    retries are turned off so that throttling shows up in the stats and the adaptive
+    controller can react to it. If if_match is given, S3 refuses (with a 412) to send
+    anything but that ETag, so ranges of different versions of a key can't get mixed."""
+    headers = {}
+    if if_match:
+        headers['If-Match'] = if_match
+    expected_bytes = key.size
+    if start is not None:
+        headers['Range'] = 'bytes=%d-%d' % (start, end)
+        expected_bytes = end - start + 1
+    # the listing already told us everything we need to know about the key, so
+    # skip the HEAD request that get_key would make
+    s3_key = get_bucket(key.bucket_name).new_key(key.key_name)
+    initial_position = fp.tell()
+    attempt = 0
+    while True:
         try:
-            os.link(fd.name, output_name)
-        except OSError as e:
-            if e.errno == 17:
-                os.unlink(output_name)
-                os.link(fd.name, output_name)
+            if stats is None:
+                s3_key.get_file(fp, headers=headers, override_num_retries=0)
             else:
+                with stats.request(key.key_name, expected_bytes) as request:
+                    s3_key.get_file(
+                        MeteredFile(fp, request, bandwidth_limit),
+                        headers=headers,
+                        override_num_retries=0
+                    )
+            return
+        except boto.exception.BotoServerError as e:
+            # with retries off, boto raises a plain BotoServerError for 5xx responses
+            if e.status < 500 or attempt >= max_retries:
+                raise
+            throttled = _is_throttle(e)
+        if stats is not None:
+            if throttled:
+                stats.on_throttle()
+            stats.on_retry()
+        time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)))
+        attempt += 1
+        fp.seek(initial_position)
+
+
+class Checkpoint(object):
+    """Which bytes of a key have safely landed in its staging file.
+
+    Partial downloads live in STAGING_DIR under the target dir, next to a JSON
+    checkpoint of the byte ranges which have been written and fsynced. A later attempt
+    (or a later run) only fetches what's missing, as long as the ETag and size in the
+    checkpoint still match the listing."""
+
+    def __init__(self, key, target_dir):
+        staging_dir = os.path.join(target_dir, STAGING_DIR)
+        if not os.path.isdir(staging_dir):
+            try:
+                os.mkdir(staging_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # keys from different prefixes can share a basename, so name the files after the whole key
+        ident = '%s/%s\0%s' % (key.bucket_name, key.key_name, key.etag)
+        if isinstance(ident, unicode):
+            ident = ident.encode('utf-8')
+        name = hashlib.sha1(ident).hexdigest()
+        self.key = key
+        self.part_name = os.path.join(staging_dir, name + '.part')
+        self.path = os.path.join(staging_dir, name + '.checkpoint')
+        self.lock = threading.Lock()
+        # sorted, non-overlapping [start, end) pairs
+        self.ranges = []
+        self.resumed = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+        if (
+            state is not None and
+            state['etag'] == self.key.etag and state['size'] == self.key.size and
+            os.path.exists(self.part_name) and os.path.getsize(self.part_name) == self.key.size
+        ):
+            self.ranges = [tuple(r) for r in state['ranges']]
+            self.resumed = bool(self.ranges)
+        else:
+            # preallocate, so that parts can be written at their own offsets
+            with open(self.part_name, 'wb') as f:
+                f.truncate(self.key.size)
+
+    def _save(self):
+        tmp_name = self.path + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({'etag': self.key.etag, 'size': self.key.size, 'ranges': self.ranges}, f)
+        os.rename(tmp_name, self.path)
+
+    def missing(self, start=0, end=None):
+        """Return the inclusive (start, end) ranges between start and end which haven't been written"""
+        if end is None:
+            end = self.key.size - 1
+        gaps = []
+        with self.lock:
+            for done_start, done_end in self.ranges:
+                if done_end <= start:
+                    continue
+                if done_start > end:
+                    break
+                if done_start > start:
+                    gaps.append((start, done_start - 1))
+                start = done_end
+        if start <= end:
+            gaps.append((start, end))
+        return gaps
+
+    def mark_done(self, start, end):
+        """Record that [start, end) is on disk"""
+        if end <= start:
+            return
+        with self.lock:
+            merged = []
+            for r_start, r_end in sorted(self.ranges + [(start, end)]):
+                if merged and r_start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], r_end))
+                else:
+                    merged.append((r_start, r_end))
+            self.ranges = merged
+            self._save()
+
+    def _verify(self):
+        if self.missing():
+            raise IOError('%s is incomplete' % self.part_name)
+        if os.path.getsize(self.part_name) != self.key.size:
+            raise IOError('%s is %d bytes, expected %d' % (
+                self.part_name, os.path.getsize(self.part_name), self.key.size))
+        etag = (self.key.etag or '').strip('"')
+        # multipart ETags aren't a plain MD5 of the contents, so there's nothing to check them
+        # against. Fresh downloads were fetched in one go with If-Match, so only pay for
+        # re-reading the file when bytes from an earlier attempt are involved.
+        if self.resumed and etag and '-' not in etag:
+            digest = hashlib.md5()
+            with open(self.part_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != etag:
+                self.discard()
+                raise IOError('%s does not match ETag %s; discarded it' % (self.part_name, etag))
+
+    def finish(self, output_name):
+        """Check the staging file and atomically move it into place"""
+        self._verify()
+        os.chmod(self.part_name, 0644)
+        os.rename(self.part_name, output_name)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        return output_name
+
+    def discard(self):
+        for name in (self.part_name, self.path):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
+class CheckpointingFile(object):
+    """Write part of a staging file, recording progress every CHECKPOINT_INTERVAL bytes"""
+
+    def __init__(self, fp, checkpoint, position):
+        self.fp = fp
+        self.checkpoint = checkpoint
+        self.synced = position
+        self.position = position
+        self.fp.seek(position)
+
+    def write(self, data):
+        self.fp.write(data)
+        self.position += len(data)
+        if self.position - self.synced >= CHECKPOINT_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.checkpoint.mark_done(self.synced, self.position)
+        self.synced = self.position
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        self.fp.seek(position)
+        self.position = self.synced = position
+
+
+def fill(checkpoint, start, end, stats=None, bandwidth_limit=None, retries=MAX_RETRIES):
+    """Fetch whatever is still missing between start and end (inclusive) into a staging file.
+
+    Dropped connections and short reads are retried from the last checkpoint."""
+    attempt = 0
+    while True:
+        gaps = checkpoint.missing(start, end)
+        if not gaps:
+            return
+        try:
+            for gap_start, gap_end in gaps:
+                # every range gets its own file object, so seeking is safe even though
+                # other workers are writing other ranges of the same file
+                with open(checkpoint.part_name, 'r+b') as fd:
+                    writer = CheckpointingFile(fd, checkpoint, gap_start)
+                    try:
+                        fetch(checkpoint.key, writer, stats, gap_start, gap_end, bandwidth_limit,
+                              if_match=checkpoint.key.etag)
+                    finally:
+                        writer.sync()
+                    if writer.position != gap_end + 1:
+                        raise IOError('Short read for %s bytes %d-%d (got up to %d)' % (
+                            checkpoint.key.key_name, gap_start, gap_end, writer.position))
+        except (IOError, httplib.HTTPException):
+            if attempt >= retries:
                 raise
-        os.chmod(output_name, 0644)
+        else:
+            continue
+        if stats is not None:
+            stats.on_retry()
+        time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)))
+        attempt += 1
+
+
+def fetch_whole(key, output_name, stats=None, bandwidth_limit=None, retries=MAX_RETRIES):
+    """Fetch a key into a temporary file next to output_name and rename it into place.
+
+    For keys too small to ever reach a checkpoint, where a staging file would only add syscalls."""
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(output_name) or '.',
+        prefix='.%s.' % os.path.basename(output_name),
+        suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            attempt = 0
+            while True:
+                try:
+                    fetch(key, fp, stats, bandwidth_limit=bandwidth_limit, if_match=key.etag)
+                    if fp.tell() != key.size:
+                        raise IOError('Short read for %s (got %d of %d bytes)' % (key.key_name, fp.tell(), key.size))
+                    break
+                except (IOError, httplib.HTTPException):
+                    if attempt >= retries:
+                        raise
+                if stats is not None:
+                    stats.on_retry()
+                time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)))
+                attempt += 1
+                fp.seek(0)
+                fp.truncate()
+        os.chmod(tmp_name, 0644)
+        os.rename(tmp_name, output_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+def download_key(key, target_dir, allow_overwrite=False, manifest=None, stats=None, bandwidth_limit=None,
+                 retries=MAX_RETRIES):
+    output_name = output_name_for(key, target_dir)
+    if manifest is not None and manifest.is_current(key, output_name):
+        return output_name, False
+    if os.path.exists(output_name) and not allow_overwrite:
+        return output_name, False
+    if key.size < CHECKPOINT_INTERVAL:
+        fetch_whole(key, output_name, stats, bandwidth_limit, retries)
+    else:
+        checkpoint = Checkpoint(key, target_dir)
+        fill(checkpoint, 0, key.size - 1, stats, bandwidth_limit, retries)
+        checkpoint.finish(output_name)
+    if manifest is not None:
+        manifest.record(key)
     return output_name, True
 
 
-def main():
+def split_key(key, checkpoint, part_size):
+    """Return the Parts needed to fill in whatever a key's staging file is missing"""
+    return [
+        Part(key, checkpoint, start, min(start + part_size - 1, gap_end))
+        for gap_start, gap_end in checkpoint.missing()
+        for start in xrange(gap_start, gap_end + 1, part_size)
+    ]
+
+
+def download_part(part, stats=None, bandwidth_limit=None, retries=MAX_RETRIES):
+    fill(part.checkpoint, part.start, part.end, stats, bandwidth_limit, retries)
+    return part
+
+
+def finish_split_key(part, target_dir):
+    return part.checkpoint.finish(output_name_for(part.key, target_dir))
+
+
+class GzipDecoder(object):
+    """Incrementally decompress gzip data, including multi-member files like those from pigz"""
+
+    def __init__(self):
+        self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data):
+        out = []
+        while data:
+            out.append(self.obj.decompress(data))
+            data = self.obj.unused_data
+            if data:
+                self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b''.join(out)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class ZstdDecoder(object):
+    def __init__(self):
+        if zstandard is None:
+            raise ValueError('The zstandard module is required to decompress .zst keys')
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+DECODERS = {
+    '.gz': GzipDecoder,
+    '.zst': ZstdDecoder,
+}
+
+
+class DecodingWriter(object):
+    """Decompress data on its way into another file-like object"""
+
+    def __init__(self, fp, decoder):
+        self.fp = fp
+        self.decoder = decoder
+
+    def write(self, data):
+        decoded = self.decoder.decode(data)
+        if decoded:
+            self.fp.write(decoded)
+
+    def close(self):
+        tail = self.decoder.flush()
+        if tail:
+            self.fp.write(tail)
+        self.fp.close()
+
+
+class StreamWriter(object):
+    """A file-like object which only moves forwards.
+
+    fetch() seeks back to where it started when retrying, which is fine as long as
+    nothing has been written yet (S3 throttles before sending a body). Anything else
+    can't be undone once it has gone down a pipe, so it's an error."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        self.fp.write(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        if position != self.position:
+            raise IOError('Cannot rewind a streaming download')
+
+
+class MuxStream(object):
+    """One key's worth of output; see StreamMux"""
+
+    def __init__(self, mux, seq):
+        self.mux = mux
+        self.seq = seq
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, data):
+        mux = self.mux
+        with mux.cond:
+            while not mux._claim(self):
+                if not self.chunks or self.buffered + len(data) <= mux.buffer_size:
+                    self.chunks.append(data)
+                    self.buffered += len(data)
+                    return
+                mux.cond.wait()
+        self._drain()
+        mux.out.write(data)
+
+    def _drain(self):
+        for chunk in self.chunks:
+            self.mux.out.write(chunk)
+        self.chunks = []
+        self.buffered = 0
+
+    def close(self):
+        mux = self.mux
+        with mux.cond:
+            if not mux._claim(self):
+                # whoever owns the output writes our buffer out once they're done
+                mux.finished[self.seq] = self
+                return
+        self._drain()
+        mux._release(self)
+
+
+class StreamMux(object):
+    """Concatenate many concurrent downloads onto one output without interleaving them.
+
+    One stream at a time owns the output and writes straight through to it. Everybody
+    else buffers up to buffer_size bytes in memory and then blocks. When ordered is set,
+    ownership passes in listing order; otherwise it goes to whichever stream is ready
+    first. The engine hands out tasks in listing order to threads that already hold a
+    concurrency slot, so the stream at the head of the line is always running and
+    can't be starved by the ones waiting behind it."""
+
+    def __init__(self, out, ordered=False, buffer_size=8 << 20):
+        self.out = out
+        self.ordered = ordered
+        self.buffer_size = buffer_size
+        self.cond = threading.Condition()
+        self.owner = None
+        self.next_seq = 0
+        self.finished = {}
+
+    def open(self, task):
+        return MuxStream(self, task.seq)
+
+    def _claim(self, stream):
+        if self.owner is stream:
+            return True
+        if self.owner is None and (not self.ordered or stream.seq == self.next_seq):
+            self.owner = stream
+            return True
+        return False
+
+    def _release(self, stream):
+        while stream is not None:
+            with self.cond:
+                self.owner = None
+                self.next_seq += 1
+                if self.ordered:
+                    stream = self.finished.pop(self.next_seq, None)
+                elif self.finished:
+                    stream = self.finished.pop(next(iter(self.finished)))
+                else:
+                    stream = None
+                self.owner = stream
+                self.cond.notify_all()
+            if stream is not None:
+                stream._drain()
+
+    def close(self):
+        self.out.flush()
+
+
+class ExecOutput(object):
+    """Pipe each key into its own copy of a shell command"""
+
+    def __init__(self, command):
+        self.command = command
+
+    def open(self, task):
+        env = dict(os.environ, S3_BUCKET=task.key.bucket_name, S3_KEY=task.key.key_name)
+        return ExecStream(subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, env=env), task.key)
+
+    def close(self):
+        pass
+
+
+class ExecStream(object):
+    def __init__(self, proc, key):
+        self.proc = proc
+        self.key = key
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, 'command for %s' % self.key.key_name)
+
+
+def stream_key(task, output, decompress=False, stats=None, bandwidth_limit=None):
+    stream = output.open(task)
+    decoder = DECODERS.get(os.path.splitext(task.key.key_name)[1]) if decompress else None
+    if decoder is not None:
+        stream = DecodingWriter(stream, decoder())
+    fetch(task.key, StreamWriter(stream), stats, bandwidth_limit=bandwidth_limit)
+    stream.close()
+    return 's3://%s/%s' % (task.key.bucket_name, task.key.key_name), True
+
+
+def plan_stream_tasks(keys, counts):
+    for key in keys:
+        yield StreamTask(key, counts['keys'])
+        counts['keys'] += 1
+
+
+def plan_tasks(keys, target_dir, allow_overwrite, split_threshold, part_size, pending_parts, counts,
+               manifest=None):
+    """Turn a stream of RemoteKeys into a stream of download tasks.
+
+    Keys at least split_threshold bytes long become several Parts (covering only what
+    earlier attempts didn't already fetch); the number of outstanding parts for each
+    staging file is recorded in pending_parts."""
+    for key in keys:
+        counts['keys'] += 1
+        output_name = output_name_for(key, target_dir)
+        if (
+            split_threshold and key.size >= split_threshold and
+            (allow_overwrite or not os.path.exists(output_name)) and
+            (manifest is None or not manifest.is_current(key, output_name))
+        ):
+            parts = split_key(key, Checkpoint(key, target_dir), part_size)
+            if parts:
+                pending_parts[parts[0].checkpoint.part_name] = len(parts)
+                for part in parts:
+                    yield part
+                continue
+        # if an earlier run already fetched every part, download_key just finishes it off
+        yield key
+
+
+def run_task(task, target_dir, allow_overwrite=False, manifest=None, stats=None, bandwidth_limit=None,
+             output=None, decompress=False, retries=MAX_RETRIES):
+    if isinstance(task, StreamTask):
+        return stream_key(task, output, decompress, stats, bandwidth_limit)
+    if isinstance(task, Part):
+        return download_part(task, stats, bandwidth_limit, retries)
+    return download_key(task, target_dir, allow_overwrite, manifest, stats, bandwidth_limit, retries)
+
+
+class DownloadEngine(object):
+    """Run tasks on a fixed set of threads.
+
+    Each thread holds its own persistent S3 connection (see get_bucket), so
+    max_parallelism is the number of requests in flight rather than the number of
+    processes. If a ConcurrencyLimit is given, only that many of the threads run tasks
+    at once. Tasks are pulled lazily through a bounded queue and results are yielded
+    by run() in completion order."""
+
+    def __init__(self, func, max_parallelism, limit=None):
+        self.func = func
+        self.max_parallelism = max_parallelism
+        self.limit = limit or ConcurrencyLimit(max_parallelism)
+        self.tasks = Queue.Queue(maxsize=max_parallelism * 2)
+        self.results = Queue.Queue()
+        self.stopping = threading.Event()
+        self.feeder = None
+
+    def _put_task(self, task):
+        while not self.stopping.is_set():
+            try:
+                self.tasks.put(task, timeout=0.5)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _feed(self, tasks):
+        try:
+            for task in tasks:
+                if not self._put_task(task):
+                    break
+        except Exception:
+            self.results.put((None, None, sys.exc_info()))
+        finally:
+            for _ in xrange(self.max_parallelism):
+                self._put_task(_STOP)
+
+    def _work(self):
+        try:
+            while not self.stopping.is_set():
+                # take the slot before the task, so tasks start in the order they were queued
+                self.limit.acquire()
+                task = self.tasks.get()
+                if task is _STOP:
+                    self.limit.release()
+                    break
+                try:
+                    self.results.put((task, self.func(task), None))
+                except Exception:
+                    self.results.put((task, None, sys.exc_info()))
+                finally:
+                    self.limit.release()
+        finally:
+            self.results.put((_STOP, None, None))
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, tasks):
+        self.feeder = self._start_thread(self._feed, tasks)
+        for _ in xrange(self.max_parallelism):
+            self._start_thread(self._work)
+        running = self.max_parallelism
+        while running:
+            try:
+                # poll so that KeyboardInterrupt gets delivered to the main thread
+                task, result, exc_info = self.results.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if task is _STOP:
+                running -= 1
+            elif exc_info is not None:
+                self.stop()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                yield result
+
+    def stop(self):
+        self.stopping.set()
+        if self.feeder is not None:
+            self.feeder.join(1)
+
+
+def write_stats(stats, path):
+    summary = json.dumps(stats.summary(), indent=2, sort_keys=True)
+    if path == '-':
+        print >>sys.stderr, summary
+    else:
+        with open(path, 'w') as f:
+            f.write(summary + '\n')
+
+
+def main(argv=None):
     assert 'AWS_ACCESS_KEY_ID' in os.environ, '$AWS_ACCESS_KEY_ID must be in the environment'
     assert 'AWS_SECRET_ACCESS_KEY' in os.environ,\
         '$AWS_SECRET_ACCESS_KEY must be in the environment'
@@ -70,12 +1300,42 @@ def main():
         action='store_true',
         help='If passed, will re-download files which already exist and overwrite'
     )
+    parser.add_argument(
+        '--sync',
+        default=False,
+        action='store_true',
+        help='Keep a manifest in the target dir and only download keys which are new or whose ETag or size changed'
+    )
     parser.add_argument(
         '-p',
         '--max-parallelism',
-        default=multiprocessing.cpu_count(),
+        default=32,
         type=int,
-        help='Max # of workers to run (default %(default)s)'
+        help='Max # of requests to keep in flight (default %(default)s)'
+    )
+    parser.add_argument(
+        '--adaptive',
+        default=False,
+        action='store_true',
+        help='Start with --initial-parallelism requests in flight and adjust up to --max-parallelism '
+        'based on throughput, latency and throttling'
+    )
+    parser.add_argument(
+        '--initial-parallelism',
+        default=4,
+        type=int,
+        help='# of requests in flight to start with when --adaptive (default %(default)s)'
+    )
+    parser.add_argument(
+        '--max-bandwidth',
+        default=None,
+        type=parse_size,
+        help='Cap aggregate download bandwidth at this many bytes/sec (e.g. 500M)'
+    )
+    parser.add_argument(
+        '--endpoint',
+        default=None,
+        help='URL of an S3-compatible service to use instead of AWS (e.g. http://localhost:9000)'
     )
     parser.add_argument(
         '-t',
@@ -83,27 +1343,179 @@ def main():
         default=os.getcwd(),
         help='Dir to write output to (default .)'
     )
-    parser.add_argument('files_or_globs', nargs='+', help='Set of either s3 paths or globs')
-    args = parser.parse_args()
+    parser.add_argument(
+        '-s',
+        '--split-threshold',
+        default=None,
+        type=parse_size,
+        help='Split keys at least this large (e.g. 1G) into ranged GETs spread across workers (default off)'
+    )
+    parser.add_argument(
+        '--part-size',
+        default=64 << 20,
+        type=parse_size,
+        help='Size of each ranged GET when splitting keys (default %(default)s)'
+    )
+    parser.add_argument(
+        '--retries',
+        default=MAX_RETRIES,
+        type=int,
+        help='Resume each download from its last checkpoint this many times before giving up '
+        '(default %(default)s)'
+    )
+    parser.add_argument(
+        '--list-parallelism',
+        default=8,
+        type=int,
+        help='Max # of prefixes to list at once when expanding globs (default %(default)s)'
+    )
+    stream_group = parser.add_mutually_exclusive_group()
+    stream_group.add_argument(
+        '--stdout',
+        default=False,
+        action='store_true',
+        help='Concatenate keys onto stdout instead of writing files'
+    )
+    stream_group.add_argument(
+        '--pipe',
+        default=None,
+        help='Concatenate keys into this file or named pipe instead of writing files'
+    )
+    stream_group.add_argument(
+        '--exec',
+        dest='exec_command',
+        default=None,
+        help='Pipe each key into its own copy of this shell command, with $S3_BUCKET and $S3_KEY set'
+    )
+    parser.add_argument(
+        '-z',
+        '--decompress',
+        default=False,
+        action='store_true',
+        help='When streaming, decompress .gz and .zst keys on the fly'
+    )
+    parser.add_argument(
+        '--ordered',
+        default=False,
+        action='store_true',
+        help='When concatenating, write keys in listing order rather than as they become ready'
+    )
+    parser.add_argument(
+        '--buffer-size',
+        default=8 << 20,
+        type=parse_size,
+        help='When concatenating, bytes to buffer per key while waiting for the output (default %(default)s)'
+    )
+    parser.add_argument(
+        '--progress-interval',
+        default=10,
+        type=float,
+        help='Print a progress line to stderr every this many seconds; 0 to disable (default %(default)s)'
+    )
+    parser.add_argument(
+        '--stats-file',
+        default=None,
+        help='Write a JSON summary of throughput and latency here when done (- for stderr)'
+    )
+    parser.add_argument('files_or_globs', nargs='+', help='Set of either s3 paths or globs (*, ?, [...] and **)')
+    args = parser.parse_args(argv)
+    if args.endpoint:
+        set_endpoint(args.endpoint)
+    streaming = args.stdout or args.pipe or args.exec_command
+    if streaming and (args.sync or args.split_threshold):
+        parser.error('--sync and --split-threshold only make sense when writing files')
 
-    files = expand_globs(args.files_or_globs)
+    keys = expand_globs(args.files_or_globs, list_parallelism=args.list_parallelism)
+    manifest = Manifest(args.target_dir) if args.sync else None
+    # in sync mode the manifest decides what gets skipped, so changed files are overwritten
+    allow_overwrite = args.allow_overwrite or args.sync
 
-    if not files:
-        print >>sys.stderr, "No S3 keys matched that glob. Womp."
-        return 1
+    stats = Stats()
+    bandwidth_limit = BandwidthLimit(args.max_bandwidth) if args.max_bandwidth else None
+    if args.adaptive:
+        limit = ConcurrencyLimit(min(args.initial_parallelism, args.max_parallelism))
+    else:
+        limit = ConcurrencyLimit(args.max_parallelism)
+    # staging file name -> number of parts which haven't finished yet
+    pending_parts = {}
+    counts = collections.Counter()
+    output = None
+    if args.stdout:
+        output = StreamMux(sys.stdout, args.ordered, args.buffer_size)
+    elif args.pipe:
+        output = StreamMux(open(args.pipe, 'wb'), args.ordered, args.buffer_size)
+    elif args.exec_command:
+        output = ExecOutput(args.exec_command)
+    if output is not None:
+        tasks = plan_stream_tasks(keys, counts)
+    else:
+        tasks = plan_tasks(
+            keys,
+            target_dir=args.target_dir,
+            allow_overwrite=allow_overwrite,
+            split_threshold=args.split_threshold,
+            part_size=args.part_size,
+            pending_parts=pending_parts,
+            counts=counts,
+            manifest=manifest,
+        )
 
-    pool = multiprocessing.Pool(min(len(files), args.max_parallelism))
+    engine = DownloadEngine(
+        functools.partial(
+            run_task,
+            target_dir=args.target_dir,
+            allow_overwrite=allow_overwrite,
+            manifest=manifest,
+            stats=stats,
+            bandwidth_limit=bandwidth_limit,
+            output=output,
+            decompress=args.decompress,
+            retries=args.retries,
+        ),
+        args.max_parallelism,
+        limit,
+    )
+    stop_reporting = threading.Event()
+    if args.adaptive:
+        controller = AdaptiveController(limit, stats, args.max_parallelism)
+        controller_thread = threading.Thread(target=controller.run, args=(stop_reporting, ))
+        controller_thread.daemon = True
+        controller_thread.start()
+    if args.progress_interval > 0:
+        reporter = threading.Thread(target=report_progress, args=(stats, args.progress_interval, stop_reporting))
+        reporter.daemon = True
+        reporter.start()
     try:
-        for downloaded_file, actually_downloaded in pool.imap(
-                functools.partial(
-                    download_key,
-                    target_dir=args.target_dir,
-                    allow_overwrite=args.allow_overwrite,
-                ),
-                files):
-            print downloaded_file, actually_downloaded
+        for result in engine.run(tasks):
+            if isinstance(result, Part):
+                pending_parts[result.checkpoint.part_name] -= 1
+                if pending_parts[result.checkpoint.part_name] == 0:
+                    del pending_parts[result.checkpoint.part_name]
+                    print finish_split_key(result, args.target_dir), True
+                    if manifest is not None:
+                        manifest.record(result.key)
+            else:
+                downloaded_file, actually_downloaded = result
+                if not actually_downloaded:
+                    stats.on_skip()
+                # stdout might be where the data is going
+                print >>(sys.stderr if args.stdout else sys.stdout), downloaded_file, actually_downloaded
+            if manifest is not None:
+                manifest.maybe_save()
     except KeyboardInterrupt:
-        pool.terminate()
+        engine.stop()
+        return 1
+    finally:
+        # anything left in the staging dir gets picked up again by the next run
+        if output is not None:
+            output.close()
+        if manifest is not None:
+            manifest.save()
+        stop_reporting.set()
+        if args.stats_file is not None:
+            write_stats(stats, args.stats_file)
+    if not counts['keys']:
+        print >>sys.stderr, "No S3 keys matched that glob. Womp."
         return 1
     return 0
 
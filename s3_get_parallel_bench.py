@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+# Benchmark s3_get_parallel against a local S3 stand-in, so that regressions in the
+# parallel download path show up without touching AWS. The stub serves synthetic
+# objects from memory (well, from a formula) and can add latency and 503 SlowDowns.
+
+import argparse
+import bisect
+import BaseHTTPServer
+import collections
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import sys
+import urlparse
+from xml.sax.saxutils import escape
+
+import s3_get_parallel
+
+BUCKET = 'bench'
+PATTERN_SIZE = 64 * 1024
+MULTIPART_THRESHOLD = 8 << 20
+LAST_MODIFIED = '2026-10-18T00:00:00.000Z'
+
+# name -> (list of (key name, size), glob to fetch, extra s3_get_parallel arguments)
+Scenario = collections.namedtuple('Scenario', ['keys', 'glob', 'args'])
+
+
+def _sizes(count, mean, sigma, rng):
+    """count sizes from a lognormal distribution with the given mean (in bytes)"""
+    if not sigma:
+        return [int(mean)] * count
+    # pick mu so that the distribution's mean comes out at mean
+    mu = math.log(mean) - sigma ** 2 / 2
+    return [max(1, int(rng.lognormvariate(mu, sigma))) for _ in xrange(count)]
+
+
+def build_scenarios(scale, rng):
+    def n(count):
+        return max(1, int(count * scale))
+
+    tiny = _sizes(n(2000), 4096, 1.0, rng)
+    huge = _sizes(n(4), 64 << 20, 0, rng)
+    throttled = _sizes(n(500), 16384, 0.5, rng)
+    deep = []
+    for host in xrange(n(50)):
+        for day in xrange(1, 31):
+            # s3_get_parallel names files by basename, so keep those unique
+            deep.append(('logs/host%03d/2026-10-%02d/host%03d.log.gz' % (host, day, host), 8192))
+    return collections.OrderedDict([
+        ('many-tiny', Scenario(
+            [('tiny/%06d' % i, size) for i, size in enumerate(tiny)],
+            'tiny/*',
+            [],
+        )),
+        ('few-huge', Scenario(
+            [('huge/%02d' % i, size) for i, size in enumerate(huge)],
+            'huge/*',
+            ['--split-threshold', '16M', '--part-size', '8M'],
+        )),
+        ('deep-globs', Scenario(deep, 'logs/*/2026-10-18/*.gz', [])),
+        ('throttled', Scenario(
+            [('throttled/%06d' % i, size) for i, size in enumerate(throttled)],
+            'throttled/*',
+            ['--adaptive'],
+        )),
+    ])
+
+
+class FakeS3(object):
+    """The objects in the stub bucket plus the knobs and counters for the handler"""
+
+    def __init__(self, keys, latency=0.0, throttle_rate=0.0, throttle_prefix=''):
+        self.keys = sorted(keys)
+        self.names = [name for name, _ in self.keys]
+        self.sizes = dict(self.keys)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_prefix = throttle_prefix
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.etags = {}
+        self.pattern = ''.join(chr(i % 251) for i in xrange(PATTERN_SIZE))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def etag(self, name):
+        """A real MD5 for small objects; big ones look like they came from a multipart upload"""
+        with self.lock:
+            etag = self.etags.get(name)
+        if etag is None:
+            size = self.sizes[name]
+            if size <= MULTIPART_THRESHOLD:
+                digest = hashlib.md5()
+                for chunk in self.body(name, 0, size - 1):
+                    digest.update(chunk)
+                etag = '"%s"' % digest.hexdigest()
+            else:
+                etag = '"%s-%d"' % (
+                    hashlib.md5('%s:%d' % (name, size)).hexdigest(), -(-size // MULTIPART_THRESHOLD))
+            with self.lock:
+                self.etags[name] = etag
+        return etag
+
+    def body(self, name, start, end):
+        """Yield bytes start-end (inclusive) of an object, a chunk at a time"""
+        offset = (start + hash(name)) % PATTERN_SIZE
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = self.pattern[offset:offset + remaining]
+            yield chunk
+            remaining -= len(chunk)
+            offset = 0
+
+    def list(self, prefix, delimiter, marker, max_keys):
+        """Return (keys, common prefixes, truncated) like a v1 ListObjects"""
+        keys, prefixes = [], []
+        i = bisect.bisect_left(self.names, max(prefix, marker))
+        while i < len(self.names) and len(keys) + len(prefixes) < max_keys:
+            name = self.names[i]
+            if not name.startswith(prefix):
+                break
+            if name <= marker or (delimiter and marker.endswith(delimiter) and name.startswith(marker)):
+                # boto pages with the last key *or common prefix* it saw as the marker
+                i += 1
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+                prefixes.append(common)
+                # skip everything else rolled up into this prefix
+                i = bisect.bisect_left(self.names, common + '\xff')
+            else:
+                keys.append(name)
+                i += 1
+        truncated = i < len(self.names) and self.names[i].startswith(prefix)
+        return keys, prefixes, truncated
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def s3(self):
+        return self.server.s3
+
+    def _send(self, status, body='', headers=()):
+        self.send_response(status)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code, message):
+        self.s3.count('error_%d' % status)
+        self._send(status, (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, message)
+        ), [('Content-Type', 'application/xml')])
+
+    def _parse(self):
+        parsed = urlparse.urlparse(self.path)
+        parts = parsed.path.lstrip('/').split('/', 1)
+        query = dict((k, v[0]) for k, v in urlparse.parse_qs(parsed.query, keep_blank_values=True).items())
+        return parts[0], urlparse.unquote(parts[1]) if len(parts) > 1 else '', query
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if self.s3.latency:
+            time.sleep(self.s3.latency)
+        if bucket != BUCKET:
+            return self._error(404, 'NoSuchBucket', 'The specified bucket does not exist')
+        if not key:
+            return self._list(query)
+        if key not in self.s3.sizes:
+            return self._error(404, 'NoSuchKey', 'The specified key does not exist.')
+        if (
+            self.command == 'GET' and key.startswith(self.s3.throttle_prefix) and
+            random.random() < self.s3.throttle_rate
+        ):
+            return self._error(503, 'SlowDown', 'Please reduce your request rate.')
+        self._object(key)
+
+    def _list(self, query):
+        self.s3.count('list')
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        marker = query.get('marker', '')
+        keys, prefixes, truncated = self.s3.list(prefix, delimiter, marker, int(query.get('max-keys', 1000)))
+        out = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+            '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>' % (BUCKET, escape(prefix), escape(marker)),
+            '<MaxKeys>1000</MaxKeys><IsTruncated>%s</IsTruncated>' % ('true' if truncated else 'false'),
+        ]
+        if delimiter:
+            out.append('<Delimiter>%s</Delimiter>' % escape(delimiter))
+            if truncated:
+                out.append('<NextMarker>%s</NextMarker>' % escape(max(keys + prefixes)))
+        for name in keys:
+            out.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag>'
+                '<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' % (
+                    escape(name), LAST_MODIFIED, escape(self.s3.etag(name)), self.s3.sizes[name])
+            )
+        for common in prefixes:
+            out.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(common))
+        out.append('</ListBucketResult>')
+        self._send(200, ''.join(out), [('Content-Type', 'application/xml')])
+
+    def _object(self, key):
+        size = self.s3.sizes[key]
+        start, end, status = 0, size - 1, 200
+        headers = [
+            ('ETag', self.s3.etag(key)),
+            ('Last-Modified', 'Sun, 18 Oct 2026 00:00:00 GMT'),
+            ('Content-Type', 'application/octet-stream'),
+        ]
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, last = range_header.split('=', 1)[1].split('-')
+            start, end, status = int(first), min(int(last or size - 1), size - 1), 206
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+        self.send_response(status)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if self.command == 'HEAD':
+            self.s3.count('head')
+            return
+        self.s3.count('get')
+        for chunk in self.s3.body(key, start, end):
+            self.wfile.write(chunk)
+        self.s3.count('bytes_sent', end - start + 1)
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, s3):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeS3Handler)
+        self.s3 = s3
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        # boto keeps connections alive, so kick the handler threads off of them too
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        self.server_close()
+
+
+def run_scenario(name, scenario, args):
+    s3 = FakeS3(
+        scenario.keys,
+        latency=args.latency_ms / 1000.0,
+        throttle_rate=args.throttle_rate if name == 'throttled' else 0.0,
+    )
+    server = FakeS3Server(s3)
+    server.start()
+    target_dir = tempfile.mkdtemp(prefix='s3_get_parallel_bench.')
+    stats_file = os.path.join(target_dir, '.stats.json')
+    argv = [
+        '--endpoint', server.url,
+        '--target-dir', target_dir,
+        '--progress-interval', '0',
+        '--stats-file', stats_file,
+        '--max-parallelism', str(args.max_parallelism),
+    ] + scenario.args + args.extra_args + ['s3://%s/%s' % (BUCKET, scenario.glob)]
+    stdout = sys.stdout
+    start = time.time()
+    try:
+        # s3_get_parallel prints a line per key; we only want the summary
+        sys.stdout = open(os.devnull, 'w')
+        rv = s3_get_parallel.main(argv)
+    finally:
+        sys.stdout = stdout
+        elapsed = time.time() - start
+        server.stop()
+    with open(stats_file) as f:
+        stats = json.load(f)
+    shutil.rmtree(target_dir)
+    if rv != 0:
+        raise RuntimeError('s3_get_parallel exited with %r for %s' % (rv, name))
+    return {
+        'scenario': name,
+        'elapsed_seconds': elapsed,
+        'objects': stats['requests'],
+        'bytes': stats['bytes'],
+        'bytes_per_second': stats['bytes'] / max(elapsed, 1e-6),
+        'objects_per_second': stats['requests'] / max(elapsed, 1e-6),
+        'ttfb_seconds': stats['ttfb_seconds'],
+        'latency_seconds': stats['latency_seconds'],
+        'retries': stats['retries'],
+        'server': dict(s3.counters),
+    }
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '%.1f' % (seconds * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--scenario',
+        action='append',
+        default=[],
+        help='Scenario to run; may be given more than once (default all)'
+    )
+    parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='Multiply the number of keys in each scenario by this (default %(default)s)'
+    )
+    parser.add_argument(
+        '--latency-ms',
+        type=float,
+        default=5,
+        help='Latency the stub adds to every request (default %(default)s)'
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0.2,
+        help='Fraction of GETs answered with 503 SlowDown in the throttled scenario (default %(default)s)'
+    )
+    parser.add_argument(
+        '-p',
+        '--max-parallelism',
+        type=int,
+        default=32,
+        help='Passed through to s3_get_parallel (default %(default)s)'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Seed for object sizes (default %(default)s)')
+    parser.add_argument('--json', default=False, action='store_true', help='Print results as JSON lines')
+    parser.add_argument('extra_args', nargs='*', help='Extra arguments for s3_get_parallel (after --)')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    scenarios = build_scenarios(args.scale, random.Random(args.seed))
+    for name in args.scenario:
+        if name not in scenarios:
+            parser.error('Unknown scenario %r (choose from %s)' % (name, ', '.join(scenarios)))
+
+    if not args.json:
+        print '%-12s %8s %8s %10s %10s %9s %9s %9s %8s %6s' % (
+            'scenario', 'seconds', 'objects', 'MiB/s', 'objects/s', 'ttfb p50', 'ttfb p99', 'lat p99', 'retries',
+            'lists')
+    for name, scenario in scenarios.items():
+        if args.scenario and name not in args.scenario:
+            continue
+        result = run_scenario(name, scenario, args)
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print '%-12s %8.2f %8d %10.1f %10.1f %9s %9s %9s %8d %6d' % (
+                name,
+                result['elapsed_seconds'],
+                result['objects'],
+                result['bytes_per_second'] / (1 << 20),
+                result['objects_per_second'],
+                _ms(result['ttfb_seconds']['p50']),
+                _ms(result['ttfb_seconds']['p99']),
+                _ms(result['latency_seconds']['p99']),
+                result['retries'],
+                result['server'].get('list', 0),
+            )
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
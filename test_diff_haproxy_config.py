@@ -0,0 +1,151 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import diff_haproxy_config
+
+
+SERVERS_STATE_HEADER = (
+    '# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state srv_uweight srv_iweight '
+    'srv_time_since_last_change srv_check_status srv_check_result srv_check_health srv_check_state '
+    'srv_agent_state bk_f_forced_id srv_f_forced_id srv_fqdn srv_port srvrecord'
+)
+
+CONFIG = '''
+defaults
+    default-server weight 10 inter 2s
+
+backend web
+    server web1 10.0.0.1:80 check
+    server web2 10.0.0.2:80 check weight 20
+    server web3 10.0.0.3:80 check
+
+backend api
+    default-server weight 5
+    server api1 api1.example.com:8080 check
+    server api2 10.0.1.2:8080 disabled
+'''
+
+
+def server_row(backend, name, address, port, weight, admin_state=0, fqdn='-'):
+    return '1 %s 1 %s %s 2 %d %d %d 100 6 3 4 6 0 0 0 %s %d -' % (
+        backend, name, address, admin_state, weight, weight, fqdn, port
+    )
+
+
+class FakeAdminSocket(object):
+    """Answers 'show backend' and 'show servers state' like haproxy's admin socket, one command per connection"""
+
+    def __init__(self, path, backends, rows):
+        self.responses = {
+            'show backend': '# name\n%s\n' % ''.join('%s\n' % b for b in backends),
+            'show servers state': '1\n%s\n%s\n' % (SERVERS_STATE_HEADER, ''.join('%s\n' % r for r in rows)),
+        }
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            command = conn.recv(1024).strip()
+            conn.sendall(self.responses.get(command, 'Unknown command.\n'))
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class RuntimeDiffTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'admin.sock')
+        self.config = diff_haproxy_config.parse_config(CONFIG.splitlines())
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, backends, rows):
+        self.server = FakeAdminSocket(self.path, backends, rows)
+
+    def diff(self):
+        runtime = diff_haproxy_config.read_runtime(self.path, 5.0)
+        return runtime, diff_haproxy_config.diff_runtime(diff_haproxy_config.runtime_view(self.config), runtime)
+
+    def test_read_runtime(self):
+        self.serve(['web', 'empty'], [
+            server_row('web', 'web1', '10.0.0.1', 80, 10),
+            server_row('web', 'web2', '10.0.0.2', 80, 20, admin_state=0x09),
+            server_row('web', 'web3', '10.0.0.3', 0, 1, fqdn='web3.example.com'),
+        ])
+        runtime, _ = self.diff()
+        self.assertEqual(sorted(runtime), [('backend', 'empty'), ('backend', 'web')])
+        self.assertEqual(runtime[('backend', 'empty')].servers, {})
+        servers = runtime[('backend', 'web')].servers
+        self.assertEqual(list(servers), ['web1', 'web2', 'web3'])
+        self.assertEqual(servers['web1'], diff_haproxy_config.Server('web1', '10.0.0.1:80', (('weight', '10'),)))
+        self.assertEqual(servers['web2'].options, (('weight', '20'), ('maint', None), ('drain', None)))
+        self.assertEqual(servers['web3'].address, 'web3.example.com')
+
+    def test_no_drift_with_default_server(self):
+        self.serve(['web', 'api'], [
+            server_row('web', 'web1', '10.0.0.1', 80, 10),
+            server_row('web', 'web2', '10.0.0.2', 80, 20),
+            server_row('web', 'web3', '10.0.0.3', 80, 10),
+            server_row('api', 'api1', '10.0.1.1', 8080, 5, fqdn='api1.example.com'),
+            server_row('api', 'api2', '10.0.1.2', 8080, 5, admin_state=0x04),
+        ])
+        _, diff = self.diff()
+        self.assertEqual(diff, diff_haproxy_config.ConfigDiff({}, [], []))
+
+    def test_drift(self):
+        self.serve(['web', 'extra'], [
+            server_row('web', 'web1', '10.0.0.1', 80, 0, admin_state=0x08),
+            server_row('web', 'web2', '10.0.0.2', 80, 20, admin_state=0x01),
+            server_row('web', 'web4', '10.0.0.4', 80, 10),
+        ])
+        _, diff = self.diff()
+        self.assertEqual(diff.added, [('backend', 'extra')])
+        self.assertEqual(diff.removed, [('backend', 'api')])
+        Change = diff_haproxy_config.Change
+        self.assertEqual(sorted(diff.changed[('backend', 'web')]), sorted([
+            Change('changed', 'server web1', 'weight 10 -> 0; drain added'),
+            Change('changed', 'server web2', 'maint added'),
+            Change('removed', 'server web3', '10.0.0.3:80 weight 10'),
+            Change('added', 'server web4', '10.0.0.4:80 weight 10'),
+        ]))
+
+
+class DiffDirectivesTestCase(unittest.TestCase):
+    def diff(self, lhs, rhs):
+        lconfig = diff_haproxy_config.parse_config(('frontend www\n' + lhs).splitlines())
+        rconfig = diff_haproxy_config.parse_config(('frontend www\n' + rhs).splitlines())
+        return diff_haproxy_config.diff_configs(lconfig, rconfig).changed.get(('frontend', 'www'), [])
+
+    def test_duplicate_removed_once(self):
+        changes = self.diff(
+            '    http-request set-header X-A a\n    http-request deny\n    http-request set-header X-A a\n',
+            '    http-request set-header X-A a\n    http-request deny\n',
+        )
+        self.assertEqual(changes, [diff_haproxy_config.Change('removed', 'http-request set-header X-A a', None)])
+
+    def test_duplicate_added_once(self):
+        changes = self.diff(
+            '    http-request set-header X-A a\n',
+            '    http-request set-header X-A a\n    http-request set-header X-A a\n',
+        )
+        self.assertEqual(changes, [diff_haproxy_config.Change('added', 'http-request set-header X-A a', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()